@@ -0,0 +1,24 @@
+#version 140
+#extension GL_ARB_explicit_attrib_location : require
+
+layout (std140, row_major) uniform Camera
+{
+    mat4 viewMatrix;
+    mat4 projMatrix;
+    mat4 transMatrix;
+    vec2 screenDimensions;
+    // The scale of the render target relative to the window, at most 1: the
+    // number of render target pixels per window pixel.
+    float pixelScale;
+};
+
+layout (location = 0) in vec3 vert_position;
+layout (location = 1) in vec3 instance_offset;
+layout (location = 2) in vec4 instance_colour;
+out vec4 frag_colour;
+
+void main()
+{
+    gl_Position = transMatrix * vec4(vert_position + instance_offset, 1.0f);
+    frag_colour = instance_colour;
+}
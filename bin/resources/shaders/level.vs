@@ -1,10 +1,21 @@
 #version 140
 #extension GL_ARB_explicit_attrib_location : require
 
-uniform mat4 transMatrix;
+layout (std140, row_major) uniform Camera
+{
+    mat4 viewMatrix;
+    mat4 projMatrix;
+    mat4 transMatrix;
+    vec2 screenDimensions;
+    // The scale of the render target relative to the window, at most 1: the
+    // number of render target pixels per window pixel.
+    float pixelScale;
+};
+
+uniform mat4 modelMatrix;
 layout (location = 0) in vec3 Position;
 
 void main()
 {
-    gl_Position = transMatrix * vec4(Position, 1.0f);
+    gl_Position = transMatrix * modelMatrix * vec4(Position, 1.0f);
 }
@@ -1,13 +1,38 @@
 #version 140
 #extension GL_ARB_explicit_attrib_location : require
 
-uniform mat4 transMatrix;
+layout (std140, row_major) uniform Camera
+{
+    mat4 viewMatrix;
+    mat4 projMatrix;
+    mat4 transMatrix;
+    vec2 screenDimensions;
+    // The scale of the render target relative to the window, at most 1: the
+    // number of render target pixels per window pixel.
+    float pixelScale;
+};
+
+layout (std140) uniform Palette
+{
+    vec4 palette[256];
+};
+
+// Positions may be quantised, relative to the corner of the chunk.
+uniform float positionScale;
+uniform vec3 positionOffset;
+uniform int usePalette;
+
 layout (location = 0) in vec3 vert_position;
 layout (location = 1) in vec4 vert_colour;
+layout (location = 2) in float vert_palette_index;
 out vec4 frag_colour;
 
 void main()
 {
-    gl_Position = transMatrix * vec4(vert_position, 1.0f);
-    frag_colour = vert_colour;
+    vec3 position = vert_position * positionScale + positionOffset;
+    gl_Position = transMatrix * vec4(position, 1.0f);
+    if (usePalette != 0)
+        frag_colour = palette[int(vert_palette_index)];
+    else
+        frag_colour = vert_colour;
 }
@@ -1,27 +1,43 @@
 #version 140
 #extension GL_ARB_explicit_attrib_location : require
 
-uniform mat4 transMatrix;
-uniform vec3 origin;
-uniform vec2 screenDimensions;
+layout (std140, row_major) uniform Camera
+{
+    mat4 viewMatrix;
+    mat4 projMatrix;
+    mat4 transMatrix;
+    vec2 screenDimensions;
+    // The scale of the render target relative to the window, at most 1: the
+    // number of render target pixels per window pixel.
+    float pixelScale;
+};
 
 layout (location = 0) in vec2 Position;
 layout (location = 1) in vec2 TexCoord;
+layout (location = 2) in vec3 Origin;
+layout (location = 3) in float Typed;
 
 out vec2 texCoords;
+out vec3 colour;
 
 void main()
 {
-    vec4 project_pos = transMatrix * vec4(origin, 1.0);
+    vec4 project_pos = transMatrix * vec4(Origin, 1.0);
     
     // Perspective divide, results in project_pos being in NDC.
     project_pos /= project_pos.w;
 
 
-    gl_Position = vec4(Position.x / screenDimensions.x + project_pos.x,
-                       Position.y / screenDimensions.y + project_pos.y,
+    // Scale the text so that it is the same size in the window whatever the
+    // resolution it is drawn at.
+    vec2 offset = Position * pixelScale / screenDimensions;
+    gl_Position = vec4(offset.x + project_pos.x,
+                       offset.y + project_pos.y,
                        project_pos.z,
                        1.0);
     texCoords = TexCoord;
+
+    // Typed characters are red, the rest are white.
+    colour = mix(vec3(1.0, 1.0, 1.0), vec3(1.0, 0.0, 0.0), Typed);
 }
 
@@ -0,0 +1,48 @@
+#version 140
+#extension GL_ARB_explicit_attrib_location : require
+
+layout (std140, row_major) uniform Camera
+{
+    mat4 viewMatrix;
+    mat4 projMatrix;
+    mat4 transMatrix;
+    vec2 screenDimensions;
+    // The scale of the render target relative to the window, at most 1: the
+    // number of render target pixels per window pixel.
+    float pixelScale;
+};
+
+// The width of the lines, in pixels.
+uniform float lineWidth;
+
+layout (location = 0) in vec3 line_start;
+layout (location = 1) in vec3 line_end;
+layout (location = 2) in vec4 line_colour;
+out vec4 frag_colour;
+
+void main()
+{
+    // Each segment is drawn as a triangle strip of four vertices: the start
+    // of the line on its left and right, then the end.
+    vec4 clip_start = transMatrix * vec4(line_start, 1.0);
+    vec4 clip_end = transMatrix * vec4(line_end, 1.0);
+    vec2 screen_start = clip_start.xy / clip_start.w * screenDimensions;
+    vec2 screen_end = clip_end.xy / clip_end.w * screenDimensions;
+
+    vec2 delta = screen_end - screen_start;
+    vec2 dir = length(delta) > 0.0 ? normalize(delta) : vec2(1.0, 0.0);
+    vec2 normal = vec2(-dir.y, dir.x);
+
+    vec4 clip = gl_VertexID < 2 ? clip_start : clip_end;
+    float side = gl_VertexID % 2 == 0 ? 1.0 : -1.0;
+    // Keep the lines the same width in the window, but at least a pixel wide.
+    float width = max(lineWidth * pixelScale, 1.0);
+    clip.xy += normal * side * width / screenDimensions * clip.w;
+
+    // Pull the lines slightly towards the camera, so that they aren't hidden
+    // by the faces they outline.
+    clip.z -= 0.0005 * clip.w;
+
+    gl_Position = clip;
+    frag_colour = line_colour;
+}
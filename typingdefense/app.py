@@ -1,3 +1,5 @@
+import ctypes
+import time
 import sdl2
 import sdl2.ext
 import OpenGL.GL as GL
@@ -5,9 +7,24 @@ import typingdefense.menu as menu
 import typingdefense.mainmenu as mainmenu
 import typingdefense.game as game
 import typingdefense.resources as resources
+import typingdefense.text as text
+import typingdefense.glutils as glutils
+import typingdefense.render as render
+import typingdefense.phrasebook as phrasebook
 
 
 class App(object):
+    # The longest a frame should take, in seconds. The resolution the scene
+    # is drawn at is lowered to keep frames under this.
+    TARGET_FRAMETIME = 1 / 30
+
+    # Whether to only redraw when something on screen has changed, waiting
+    # for events in between rather than drawing continuously.
+    REDRAW_ON_CHANGE = True
+
+    # The longest to wait for an event while idle, in milliseconds.
+    IDLE_TIMEOUT = 250
+
     def __init__(self):
         """Initialize the App."""
         sdl2.ext.init()
@@ -17,6 +34,11 @@ class App(object):
                                              shader_path="shaders",
                                              font_path="fonts")
 
+        # Start loading the phrase dictionaries in the background, so they are
+        # ready by the time a level starts.
+        self.phrasebooks = phrasebook.Registry()
+        self.phrasebooks.load(phrasebook.Registry.DEFAULT_DICTIONARY)
+
         self.window_width = 800
         self.window_height = 600
         self._window = sdl2.ext.Window("Typing Defense",
@@ -26,11 +48,39 @@ class App(object):
         self._gl_context = None
         self._init_gl()
 
+        # Pack the fonts and UI images into one texture, so that 2D drawing
+        # doesn't need to switch textures.
+        self.resources.build_atlas(textures=['placeholder.png'],
+                                   fonts=['hudfont.fnt', 'menufont.fnt'])
+
+        # The scene is drawn offscreen at a reduced resolution when frames
+        # take too long, and scaled up to the window. The HUD is always drawn
+        # at the window's resolution.
+        self.resolution = render.ResolutionController(
+            self.window_width, self.window_height, App.TARGET_FRAMETIME)
+        self._scene_buffer = glutils.SceneBuffer(self.window_width,
+                                                 self.window_height)
+        self._frame_start = None
+
+        # The time taken by the last frame drawn, from handling its events to
+        # the swap, leaving out any time spent waiting for events.
+        self.frametime = 0
+
+        # The camera matrices used by the level's shaders.
+        self.camera_buffer = glutils.CameraBuffer()
+
+        # Everything else drawn in a frame is submitted to the render queue.
+        self.render_queue = render.RenderQueue()
+
+        # All 2D text drawn in a frame is batched, and drawn at the end of it.
+        self.text_batch = text.TextBatch(self)
+
         self._menu = menu.Menu(mainmenu.MainMenuScreen(self))
         self._game = game.Game(self)
 
     def __del__(self):
         """Shut down the App."""
+        self.phrasebooks.shutdown()
         sdl2.SDL_GL_DeleteContext(self._gl_context)
         sdl2.ext.quit()
 
@@ -62,36 +112,91 @@ class App(object):
 
     def _draw(self):
         """Draw the next frame."""
-        GL.glClear(GL.GL_STENCIL_BUFFER_BIT |
-                   GL.GL_DEPTH_BUFFER_BIT |
-                   GL.GL_COLOR_BUFFER_BIT)
-        # self._menu.draw()
-        self._game.draw()
+        res = self.resolution
+        self.camera_buffer.set_resolution(res.width, res.height, res.scale)
+        if res.scale < 1:
+            with self._scene_buffer.enable(res.width, res.height):
+                GL.glClear(GL.GL_STENCIL_BUFFER_BIT |
+                           GL.GL_DEPTH_BUFFER_BIT |
+                           GL.GL_COLOR_BUFFER_BIT)
+                # self._menu.draw()
+                self._game.draw()
+                self.render_queue.flush(render.RenderQueue.OVERLAY)
+            self._scene_buffer.blit(res.width, res.height)
+            GL.glClear(GL.GL_STENCIL_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT)
+        else:
+            GL.glClear(GL.GL_STENCIL_BUFFER_BIT |
+                       GL.GL_DEPTH_BUFFER_BIT |
+                       GL.GL_COLOR_BUFFER_BIT)
+            # self._menu.draw()
+            self._game.draw()
+
+        # Draw the HUD at the window's resolution.
+        self.render_queue.flush()
+        self.text_batch.flush()
         sdl2.SDL_GL_SwapWindow(self._window.window)
+        glutils.state.end_frame()
+
+        # Delete any GL objects which were discarded during the frame.
+        glutils.tracker.collect()
+
+        self.frametime = time.perf_counter() - self._frame_start
+        res.update(self.frametime)
 
     def _update(self):
         """Perform any updates needed in this frame."""
         self._game.update()
 
+    def _handle_event(self, event):
+        """Handle an SDL event.
+
+        Returns False if the App should quit."""
+        if event.type == sdl2.SDL_QUIT:
+            return False
+        elif event.type == sdl2.SDL_MOUSEBUTTONDOWN:
+            self._game.on_click(event.button.x,
+                                self.window_height - event.button.y,
+                                event.button.button)
+        elif event.type == sdl2.SDL_MOUSEWHEEL:
+            self._game.on_scroll(event.wheel.y)
+        elif event.type == sdl2.SDL_TEXTINPUT:
+            # The text is UTF-8, so may have characters of several bytes.
+            for c in event.text.text.decode('utf-8', errors='ignore'):
+                self._game.on_text(c)
+        elif event.type == sdl2.SDL_KEYDOWN:
+            self._game.on_keydown(event.key.keysym.sym)
+        elif event.type == sdl2.SDL_WINDOWEVENT:
+            # The window may have been uncovered or resized.
+            self._game.dirty = True
+        return True
+
     def run(self):
         """Run the App."""
         self._window.show()
 
         run = True
         while run:
+            if App.REDRAW_ON_CHANGE and not self._game.dirty:
+                # Nothing has changed, so sleep until there is an event to
+                # handle.
+                event = sdl2.SDL_Event()
+                if sdl2.SDL_WaitEventTimeout(ctypes.byref(event),
+                                             App.IDLE_TIMEOUT):
+                    run = self._handle_event(event)
+
+            self._frame_start = time.perf_counter()
             for event in sdl2.ext.get_events():
-                if event.type == sdl2.SDL_QUIT:
-                    run = False
+                if not run:
                     break
-                elif event.type == sdl2.SDL_MOUSEBUTTONDOWN:
-                    self._game.on_click(event.button.x,
-                                        self.window_height - event.button.y,
-                                        event.button.button)
-                elif event.type == sdl2.SDL_TEXTINPUT:
-                    for c in event.text.text:
-                        self._game.on_text(chr(c))
-                elif event.type == sdl2.SDL_KEYDOWN:
-                    self._game.on_keydown(event.key.keysym.sym)
+                run = self._handle_event(event)
+            if not run:
+                break
 
             self._update()
-            self._draw()
+            if not App.REDRAW_ON_CHANGE or self._game.dirty:
+                self._draw()
+                self._game.dirty = False
+
+        # Stop loading dictionaries now, as the interpreter waits for the
+        # loader thread before the App is deleted.
+        self.phrasebooks.shutdown()
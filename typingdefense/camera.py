@@ -8,15 +8,20 @@ class Camera(object):
 
     """A camera class, implements camera and perspective transformations."""
 
+    # Limits on the distance from the camera to its target when zooming.
+    MIN_DISTANCE = 10
+    MAX_DISTANCE = 500
+
     def __init__(self, origin, target, up,
                  fov, screen_width, screen_height, near, far):
         self.origin = np.array(origin, np.float32)
+        self.target = np.array(target, np.float32)
         self.screen_width = screen_width
         self.screen_height = screen_height
         self.near = near
         self.far = far
 
-        self.forward = np.array(target, np.float32) - origin
+        self.forward = self.target - self.origin
         self.forward = self.forward / np.linalg.norm(self.forward)
 
         self.up = up / np.linalg.norm(up)
@@ -26,15 +31,11 @@ class Camera(object):
         self.right = self.right / np.linalg.norm(self.right)
         self.up = np.cross(self.right, self.forward)
 
-        rot = np.matrix([[self.right[0], self.right[1], self.right[2], 0],
-                         [self.up[0], self.up[1], self.up[2], 0],
-                         [self.forward[0], self.forward[1], self.forward[2], 0],
-                         [0, 0, 0, 1]], np.float32)
-        trans = np.matrix([[1, 0, 0, -origin[0]],
-                           [0, 1, 0, -origin[1]],
-                           [0, 0, 1, -origin[2]],
-                           [0, 0, 0, 1]], np.float32)
-        self.cam_matrix = rot * trans
+        self._rot = np.matrix(
+            [[self.right[0], self.right[1], self.right[2], 0],
+             [self.up[0], self.up[1], self.up[2], 0],
+             [self.forward[0], self.forward[1], self.forward[2], 0],
+             [0, 0, 0, 1]], np.float32)
 
         ratio = screen_width / screen_height
         tanHalfFov = math.tan(math.radians(fov / 2.0))
@@ -45,9 +46,78 @@ class Camera(object):
              [0, 0, (-near - far) / zRange, 2 * far * near / zRange],
              [0, 0, 1, 0]], np.float32)
 
-        self.trans_matrix = self.proj_matrix * self.cam_matrix
+        self.cam_matrix = np.matrix(np.identity(4, np.float32))
+        self.trans_matrix = np.matrix(np.identity(4, np.float32))
 
-    def unproject(self, screen_coords, world_z):
+        # Incremented whenever the matrices change.
+        self.version = 0
+        self._update()
+
+    def _update(self):
+        """Recalculate the transformation matrices after the camera moves.
+
+        The matrices are updated in place, so that arrays returned by
+        trans_matrix_as_array stay up to date."""
+        trans = np.matrix([[1, 0, 0, -self.origin[0]],
+                           [0, 1, 0, -self.origin[1]],
+                           [0, 0, 1, -self.origin[2]],
+                           [0, 0, 0, 1]], np.float32)
+        self.cam_matrix[:] = self._rot * trans
+        self.trans_matrix[:] = self.proj_matrix * self.cam_matrix
+        self.version += 1
+
+    def pan(self, dx, dy):
+        """Move the camera and its target across the world's x-y plane."""
+        offset = np.array([dx, dy, 0], np.float32)
+        self.origin += offset
+        self.target += offset
+        self._update()
+
+    def zoom(self, factor):
+        """Scale the distance from the camera to its target."""
+        distance = np.linalg.norm(self.target - self.origin) * factor
+        distance = min(max(distance, Camera.MIN_DISTANCE),
+                       Camera.MAX_DISTANCE)
+        self.origin = self.target - self.forward * distance
+        self._update()
+
+    def _frustum_planes(self):
+        """Extract the planes of the view frustum from the matrix.
+
+        Returns a (6, 4) array, with each row holding a plane normal and
+        distance such that points inside the frustum are on the positive side
+        of every plane."""
+        m = np.asarray(self.trans_matrix)
+        return np.array([m[3] + m[0], m[3] - m[0],
+                         m[3] + m[1], m[3] - m[1],
+                         m[3] + m[2], m[3] - m[2]])
+
+    def boxes_visible(self, mins, maxs):
+        """Test which axis-aligned boxes intersect the view frustum.
+
+        mins and maxs are (n, 3) arrays of box corners. Returns a boolean
+        array. Boxes near the corners of the frustum may be reported as
+        visible when they aren't, but visible boxes are never rejected."""
+        planes = self._frustum_planes()
+        normals = planes[:, np.newaxis, 0:3]
+        # For each plane, test the corner of each box furthest along the
+        # plane normal.
+        corners = np.where(normals >= 0, maxs, mins)
+        distances = (corners * normals).sum(axis=2) + planes[:, 3:4]
+        return (distances >= 0).all(axis=0)
+
+    def points_visible(self, points, radius=0):
+        """Test which points, or spheres of the given radius, are visible."""
+        planes = self._frustum_planes()
+        lengths = np.linalg.norm(planes[:, 0:3], axis=1)
+        distances = (np.dot(points, planes[:, 0:3].T) + planes[:, 3]) / lengths
+        return (distances >= -radius).all(axis=1)
+
+    def ray(self, screen_coords):
+        """Find the ray through a point on the screen.
+
+        Returns a point on the ray in world space, in front of the camera,
+        and the direction of the ray, as a unit vector."""
         # Convert from screen coords to NDCs
         x = screen_coords.x * 2 / self.screen_width - 1
         y = screen_coords.y * 2 / self.screen_height - 1
@@ -60,15 +130,18 @@ class Camera(object):
         world_far = inv_trans * far_coords
 
         # Perspective divide
-        world_near /= world_near[3, 0]
-        world_far /= world_far[3, 0]
+        world_near = np.asarray(world_near / world_near[3, 0])[0:3, 0]
+        world_far = np.asarray(world_far / world_far[3, 0])[0:3, 0]
 
-        world_neartofar = world_far - world_near
-        ratio = (world_z - world_near[2, 0]) / world_neartofar[2, 0]
+        direction = world_far - world_near
+        return world_near, direction / np.linalg.norm(direction)
 
-        return vector.Vector(world_near[0, 0] + (world_neartofar[0, 0] * ratio),
-                             world_near[1, 0] + (world_neartofar[1, 0] * ratio),
-                             world_near[2, 0] + (world_neartofar[2, 0] * ratio))
+    def unproject(self, screen_coords, world_z):
+        """Find the world position under a point on the screen at a given
+        height."""
+        start, direction = self.ray(screen_coords)
+        ratio = (world_z - start[2]) / direction[2]
+        return vector.Vector(*[float(v) for v in start + direction * ratio])
 
     def trans_matrix_as_array(self):
         return np.asarray(self.trans_matrix).reshape(-1)
@@ -8,7 +8,7 @@ import typingdefense.vector as vector
 import typingdefense.glutils as glutils
 import typingdefense.util as util
 import typingdefense.enemy as enemy
-import typingdefense.text as text
+import typingdefense.render as render
 import typingdefense.level
 
 
@@ -37,21 +37,26 @@ class _ColourButton(object):
         with self._vao.bind():
             self._vbo.bind()
             data_array = numpy.array(data, numpy.float32)
-            GL.glBufferData(GL.GL_ARRAY_BUFFER,
-                            data_array.nbytes, data_array,
-                            GL.GL_STATIC_DRAW)
+            glutils.buffer_data(GL.GL_ARRAY_BUFFER,
+                                data_array.nbytes, data_array,
+                                GL.GL_STATIC_DRAW)
             GL.glEnableVertexAttribArray(0)
             GL.glVertexAttribPointer(0, 2, GL.GL_FLOAT, GL.GL_FALSE, 8, None)
 
-    def draw(self, colour):
-        """Draw the button."""
+    def draw(self, queue, colour):
+        """Submit the button to a render queue."""
+        queue.submit(render.RenderQueue.HUD, self._shader.program,
+                     self._vao.id, self._draw, colour)
+
+    def _draw(self, colours):
         with self._shader.use():
             with self._vao.bind():
-                self._shader.set_uniform('colourIn',
-                                         util.Colour.from_white())
-                GL.glDrawArrays(GL.GL_LINE_LOOP, 0, 4)
-                self._shader.set_uniform('colourIn', colour)
-                GL.glDrawArrays(GL.GL_TRIANGLE_FAN, 0, 4)
+                for colour in colours:
+                    self._shader.set_uniform('colourIn',
+                                             util.Colour.from_white())
+                    GL.glDrawArrays(GL.GL_LINE_LOOP, 0, 4)
+                    self._shader.set_uniform('colourIn', colour)
+                    GL.glDrawArrays(GL.GL_TRIANGLE_FAN, 0, 4)
 
 
 class _EditorHud(object):
@@ -60,24 +65,20 @@ class _EditorHud(object):
         self._editor = editor
         self._colourbutton = _ColourButton(app, vector.Vector(10, 10))
 
-        font = app.resources.load_font('menufont.fnt')
-        self._enemy_type_text = text.Text2D(app, font, '', 0, 0, 24)
-        self._enemy_count_text = text.Text2D(app, font, '', 0, 24, 24)
-        self._start_time_text = text.Text2D(app, font, '', 0, 48, 24)
-        self._spawn_gap_text = text.Text2D(app, font, '', 0, 72, 24)
-        self._phase_text = text.Text2D(app, font, '', 0, app.window_height - 24,
-                                       24)
+        self._font = app.resources.load_font('menufont.fnt')
+        self._text = app.text_batch
+        self._phase_y = app.window_height - 24
 
-    def draw(self):
+    def draw(self, queue):
         """Draw the HUD."""
         if self._editor.state == Editor.State.tile:
-            self._colourbutton.draw(self._editor.colour)
+            self._colourbutton.draw(queue, self._editor.colour)
 
         if self._editor.state == Editor.State.wave:
             phase_str = 'Phase: {}'.format(self._editor.phase)
             if self._editor.wave_edit_mode == Editor.WaveEditMode.phase:
                 phase_str += ' +/-'
-            self._phase_text.draw(phase_str)
+            self._text.add(self._font, phase_str, 0, self._phase_y, 24)
 
         if self._editor.selected_wave is not None:
             enemy_type_str = self._editor.selected_wave.enemy_type.__name__
@@ -99,10 +100,10 @@ class _EditorHud(object):
             if self._editor.wave_edit_mode == Editor.WaveEditMode.spawn_gap:
                 spawn_gap_str += ' +/-'
 
-            self._enemy_type_text.draw(enemy_type_str)
-            self._enemy_count_text.draw(enemy_count_str)
-            self._start_time_text.draw(start_time_str)
-            self._spawn_gap_text.draw(spawn_gap_str)
+            self._text.add(self._font, enemy_type_str, 0, 0, 24)
+            self._text.add(self._font, enemy_count_str, 0, 24, 24)
+            self._text.add(self._font, start_time_str, 0, 48, 24)
+            self._text.add(self._font, spawn_gap_str, 0, 72, 24)
 
 
 class Editor(object):
@@ -142,23 +143,29 @@ class Editor(object):
         self.enemy_type = enemy.enemy_types[0]
         self.phase = 0
 
+        # Nothing in the editor moves by itself, so it only needs redrawing
+        # after input.
+        self.dirty = True
+
     def draw(self):
-        """Draw the level editor screen."""
-        self._level.picking_draw()
-
-        for _, tile in numpy.ndenumerate(self._level.tiles):
-            if tile:
-                draw_faces = (self.phase in tile.waves or
-                              self.state != Editor.State.wave)
-                if (self.phase in tile.waves and
-                        self.selected_wave is tile.waves[self.phase]):
-                    tile.draw(faces=draw_faces,
-                              face_colour=util.Colour.from_red())
+        """Submit the level editor screen to the app's render queue."""
+        queue = self._app.render_queue
+
+        # In wave state, only the faces of tiles with waves in the current
+        # phase are drawn.
+        self._level.terrain.draw(queue,
+                                 faces=(self.state != Editor.State.wave))
+        if (self.state == Editor.State.wave and
+                self.phase < len(self._level.waves)):
+            for wave in self._level.waves[self.phase]:
+                if wave is self.selected_wave:
+                    wave.tile.draw(queue, outline=False,
+                                   face_colour=util.Colour.from_red())
                 else:
-                    tile.draw(faces=draw_faces)
+                    wave.tile.draw(queue, outline=False)
 
-        self._level.base.draw()
-        self._hud.draw()
+        self._level.base.draw(queue)
+        self._hud.draw(queue)
 
     def update(self):
         """Update the editor screen."""
@@ -166,6 +173,7 @@ class Editor(object):
 
     def on_keydown(self, key):
         """Handle keydown events."""
+        self.dirty = True
         if key == sdl2.SDLK_s:
             self._level.save()
         elif key == sdl2.SDLK_t:
@@ -200,6 +208,14 @@ class Editor(object):
             self.wave_edit_mode = Editor.WaveEditMode.spawn_gap
         elif key == sdl2.SDLK_5:
             self.wave_edit_mode = Editor.WaveEditMode.phase
+        else:
+            # Let the level handle camera movement.
+            self._level.on_keydown(key)
+
+    def on_scroll(self, amount):
+        """Handle mouse wheel events."""
+        self.dirty = True
+        self._level.on_scroll(amount)
 
     def on_text(self, c):
         """Handle text input."""
@@ -225,12 +241,13 @@ class Editor(object):
             if height > 0:
                 self._level.tiles[index.y, index.x] = typingdefense.level.Tile(
                     self._app,
-                    self._level.cam,
                     tile_coords,
                     height,
                     colour)
             else:
                 self._level.tiles[index.y, index.x] = None
+            self._level.terrain.mark_dirty(tile_coords)
+            self._level.picking_draw()
 
     def _handle_wave_state_click(self, x, y, button):
         """Handle a click in wave-editing state."""
@@ -265,6 +282,7 @@ class Editor(object):
 
     def on_click(self, x, y, button):
         """Handle a mouse click."""
+        self.dirty = True
         if button != sdl2.SDL_BUTTON_LEFT and button != sdl2.SDL_BUTTON_RIGHT:
             return
 
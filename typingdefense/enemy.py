@@ -1,12 +1,9 @@
 """Module containing the different enemies that appear in the game."""
 import sys
 import math
-import numpy
-import OpenGL.GL as GL
 import typingdefense.phrase as phrase
 import typingdefense.phrasebook as phrasebook
 import typingdefense.util as util
-import typingdefense.glutils as glutils
 import typingdefense.vector as vector
 
 
@@ -25,10 +22,13 @@ class _BaseEnemy(object):
     """Base class for all enemy types."""
     _JUMP_HEIGHT = 3
     _SLOW_FACTOR = 1.5
+    SIZE = 0.5
+    DEPTH = 1
 
     def __init__(self, app, level, tile, speed, move_pause, value, damage,
                  colour, health=1, words=1,
-                 wordlength=phrasebook.PhraseBook.SHORT_PHRASE):
+                 wordlength=phrasebook.PhraseBook.SHORT_PHRASE,
+                 difficulty=None):
         # TODO:temp
         self.prev_time = 0
         self.prev_origin = vector.Vector(0, 0, 0)
@@ -40,6 +40,7 @@ class _BaseEnemy(object):
         # Phrase variables
         self._words = words
         self._wordlength = wordlength
+        self._difficulty = difficulty
         self.phrase = None
 
         # Movement variables
@@ -55,11 +56,7 @@ class _BaseEnemy(object):
         self._move_end = 0
 
         # Graphics variables
-        self._shader = glutils.ShaderInstance(
-            app, 'level.vs', 'level.fs',
-            [('transMatrix', GL.GL_FLOAT_MAT4, None),
-             ('colourIn', GL.GL_FLOAT_VEC4, colour)])
-        self._hex = glutils.Hex(vector.Vector(0, 0, 0), 0.5, 1)
+        self.colour = colour
 
         self.health = health
         self.damage = damage
@@ -89,8 +86,8 @@ class _BaseEnemy(object):
 
     def _setup_phrase(self):
         self.phrase = phrase.Phrase(
-            self._app, self._level.cam,
-            self._level.phrases.get_phrase(self._wordlength, self._words))
+            self._level.phrases.get_phrase(self._wordlength, self._words,
+                                           self._difficulty))
 
     def _setup_move(self, timer):
         if self.next_tile:
@@ -106,17 +103,17 @@ class _BaseEnemy(object):
             self._move_start = timer.time + self._scaled_pause()
             self._move_end = self._move_start + distance / self._scaled_speed()
 
-    def draw(self):
-        coords = vector.Vector(self.origin.x, self.origin.y, self.origin.z)
-        t = util.Transform(coords)
-        m = self._level.cam.trans_matrix * t.matrix
-        self._shader.set_uniform('transMatrix',
-                                 numpy.asarray(m).reshape(-1),
-                                 download=False)
-        with self._shader.use():
-            self._hex.draw()
-
-        self.phrase.draw(coords)
+    @property
+    def instance(self):
+        """The instance data used to draw the enemy's hex.
+
+        The hexes of all enemies are drawn together by the level."""
+        return (self.origin.x, self.origin.y, self.origin.z,
+                self.colour.r, self.colour.g, self.colour.b, self.colour.a)
+
+    def draw(self, phrases):
+        """Add the enemy's phrase to the level's batch of phrases."""
+        self.phrase.draw(phrases, self.origin)
 
     def on_text(self, c):
         self.phrase.on_type(c)
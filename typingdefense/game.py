@@ -9,6 +9,15 @@ class Game(object):
         self._app = app
         self._level = level.Level(app, self)
 
+    @property
+    def dirty(self):
+        """Whether the screen has changed since it was last drawn."""
+        return self._level.dirty
+
+    @dirty.setter
+    def dirty(self, dirty):
+        self._level.dirty = dirty
+
     def draw(self):
         self._level.draw()
 
@@ -24,5 +33,8 @@ class Game(object):
 
         self._level.on_keydown(key)
 
+    def on_scroll(self, amount):
+        self._level.on_scroll(amount)
+
     def on_text(self, c):
         self._level.on_text(c)
@@ -1,52 +1,371 @@
 """Various OpenGL utility classes."""
-import math
+import collections
+import ctypes
+import weakref
 import numpy
 import typingdefense.util as util
+import typingdefense.mesh as mesh
+import typingdefense.render as render
 import OpenGL.GL as GL
 from contextlib import contextmanager
 
 
-@contextmanager
-def linewidth(width):
-    GL.glLineWidth(width)
-    try:
-        yield
-    finally:
-        GL.glLineWidth(1)
+class GLState(object):
+    """Tracks the GL state, to skip redundant state changes.
+
+    All binds of programs, vertex arrays, buffers and textures, and uniform
+    uploads should go through the shared instance, state. Bindings are left
+    in place after use rather than being reset to 0, so that consecutive
+    draws with the same state don't change it at all.
+
+    The calls made and the calls avoided are counted by kind."""
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.avoided = collections.Counter()
+        self._program = None
+        self._vao = None
+        self._buffers = {}
+        self._texture = None
+
+        # The number of frames drawn so far.
+        self.frame = 0
+
+        # Uniform values, keyed by program and uniform location.
+        self._uniforms = {}
+
+    def _changed(self, kind, changed):
+        if changed:
+            self.calls[kind] += 1
+        else:
+            self.avoided[kind] += 1
+        return changed
+
+    def use_program(self, program):
+        if self._changed('program', program != self._program):
+            GL.glUseProgram(program)
+            self._program = program
+
+    def bind_vertex_array(self, vao):
+        if self._changed('vertex array', vao != self._vao):
+            GL.glBindVertexArray(vao)
+            self._vao = vao
+            # The index buffer binding is part of the vertex array state.
+            self._buffers.pop(GL.GL_ELEMENT_ARRAY_BUFFER, None)
+
+    def bind_buffer(self, target, buf):
+        if self._changed('buffer', buf != self._buffers.get(target)):
+            GL.glBindBuffer(target, buf)
+            self._buffers[target] = buf
+
+    def bind_texture(self, texture):
+        if self._changed('texture', texture != self._texture):
+            GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+            self._texture = texture
+
+    def end_frame(self):
+        """Record that a frame has been drawn."""
+        self.frame += 1
+
+    def bound_buffer(self, target):
+        """Find the buffer bound to a target."""
+        if target not in self._buffers:
+            self._buffers[target] = int(GL.glGetIntegerv(
+                _BUFFER_BINDINGS[target]))
+        return self._buffers[target]
+
+    def forget(self, kind, gl_id):
+        """Forget any binding of an object which has been deleted, since GL
+        unbinds deleted objects, and a new object may reuse the id."""
+        if kind == 'vertex array' and self._vao == gl_id:
+            self._vao = None
+            self._buffers.pop(GL.GL_ELEMENT_ARRAY_BUFFER, None)
+        elif kind == 'buffer':
+            for target, buf in list(self._buffers.items()):
+                if buf == gl_id:
+                    del self._buffers[target]
+        elif kind == 'texture' and self._texture == gl_id:
+            self._texture = None
+
+    def uniform(self, location, gl_type, value):
+        """Upload a uniform to the program in use, if its value has changed.
+
+        Returns whether the uniform was uploaded."""
+        key = (self._program, location)
+        if not isinstance(value, (int, float, numpy.ndarray)):
+            # Sequences such as Colours.
+            value = list(value)
+        value = numpy.array(value, numpy.float32)
+        cached = self._uniforms.get(key)
+        if not self._changed('uniform', cached is None or
+                             not numpy.array_equal(cached, value)):
+            return False
+
+        _UNIFORM_SETTERS[gl_type](location, value)
+        self._uniforms[key] = value
+        return True
+
+
+# Functions to upload uniforms of each type.
+_UNIFORM_SETTERS = {
+    GL.GL_INT: lambda loc, v: GL.glUniform1i(loc, int(v)),
+    GL.GL_FLOAT: lambda loc, v: GL.glUniform1f(loc, float(v)),
+    GL.GL_FLOAT_VEC2: lambda loc, v: GL.glUniform2f(loc, *v[0:2]),
+    GL.GL_FLOAT_VEC3: lambda loc, v: GL.glUniform3f(loc, *v[0:3]),
+    GL.GL_FLOAT_VEC4: lambda loc, v: GL.glUniform4f(loc, *v[0:4]),
+    GL.GL_FLOAT_MAT4: lambda loc, v: GL.glUniformMatrix4fv(
+        loc, 1, GL.GL_TRUE, v),
+}
+
+# The queries for the buffer bound to each target.
+_BUFFER_BINDINGS = {
+    GL.GL_ARRAY_BUFFER: GL.GL_ARRAY_BUFFER_BINDING,
+    GL.GL_ELEMENT_ARRAY_BUFFER: GL.GL_ELEMENT_ARRAY_BUFFER_BINDING,
+    GL.GL_UNIFORM_BUFFER: GL.GL_UNIFORM_BUFFER_BINDING,
+}
+
+# The GL state tracker shared by the whole game.
+state = GLState()
+
+
+class ResourceTracker(object):
+    """Tracks the GL objects in use, and deletes them once they are unused.
+
+    Objects are tracked along with the Python object that owns them. When the
+    owner is garbage collected, the GL object is queued for deletion, which
+    happens in collect, called at the end of each frame, since finalizers may
+    run at any time and on any thread, but GL calls must be made on the
+    thread with the context.
+
+    The number of live objects of each kind, and the memory they use, are
+    available from stats."""
+    # Functions to delete each kind of object.
+    _DELETERS = {
+        'buffer': lambda gl_id: GL.glDeleteBuffers(1, [gl_id]),
+        'vertex array': lambda gl_id: GL.glDeleteVertexArrays(1, [gl_id]),
+        'texture': lambda gl_id: GL.glDeleteTextures([gl_id]),
+        'renderbuffer': lambda gl_id: GL.glDeleteRenderbuffers(1, [gl_id]),
+        'framebuffer': lambda gl_id: GL.glDeleteFramebuffers(1, [gl_id]),
+    }
+
+    def __init__(self):
+        # The size in bytes of each live object, keyed by kind and id.
+        self._live = {}
+        # Objects waiting to be deleted. Appending to a deque is thread-safe.
+        self._pending = collections.deque()
+
+    def track(self, owner, kind, gl_id, nbytes=0):
+        """Start tracking an object, to be deleted along with its owner."""
+        self._live[(kind, gl_id)] = nbytes
+        weakref.finalize(owner, self._pending.append, (kind, gl_id))
+
+    def resize(self, kind, gl_id, nbytes):
+        """Record the new size of an object's storage."""
+        if (kind, gl_id) in self._live:
+            self._live[(kind, gl_id)] = nbytes
+
+    def collect(self):
+        """Delete the objects whose owners have been garbage collected.
+
+        Returns the number of objects deleted."""
+        count = 0
+        while self._pending:
+            kind, gl_id = self._pending.popleft()
+            ResourceTracker._DELETERS[kind](gl_id)
+            state.forget(kind, gl_id)
+            del self._live[(kind, gl_id)]
+            count += 1
+        return count
+
+    def stats(self):
+        """Count the live objects of each kind, and the bytes they use.
+
+        Returns a dictionary of (count, bytes) tuples, keyed by kind."""
+        stats = {}
+        for (kind, _), nbytes in self._live.items():
+            count, total = stats.get(kind, (0, 0))
+            stats[kind] = (count + 1, total + nbytes)
+        return stats
+
+
+# The tracker of all the game's GL objects.
+tracker = ResourceTracker()
+
+
+def buffer_data(target, nbytes, data, usage):
+    """Allocate storage for the buffer bound to a target, recording its size
+    in the tracker."""
+    GL.glBufferData(target, nbytes, data, usage)
+    tracker.resize('buffer', state.bound_buffer(target), nbytes)
+
+# The binding points of the uniform blocks shared between shaders, keyed by
+# block name.
+UNIFORM_BLOCKS = {'Camera': 0, 'Palette': 1}
 
 
 class VertexArray(object):
     def __init__(self):
         self._id = GL.glGenVertexArrays(1)
+        tracker.track(self, 'vertex array', self._id)
 
-    def __del__(self):
-        # TODO: Work out how to call this
-        # GL.glDeleteVertexArrays(1, self._id)
-        pass
+    @property
+    def id(self):
+        return self._id
 
     @contextmanager
     def bind(self):
-        GL.glBindVertexArray(self._id)
-        try:
-            yield
-        finally:
-            GL.glBindVertexArray(0)
+        state.bind_vertex_array(self._id)
+        yield
 
 
 class VertexBuffer(object):
     def __init__(self):
         self._id = GL.glGenBuffers(1)
+        tracker.track(self, 'buffer', self._id)
 
-    def __del__(self):
-        # TODO: Work out how to call this
-        # GL.glDeleteBuffers(1, self._id)
-        pass
+    @property
+    def id(self):
+        return self._id
 
     def bind(self):
         """Bind the vertex buffer."""
-        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self._id)
-        return util.OptionalContextManager(
-            lambda: GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0))
+        state.bind_buffer(GL.GL_ARRAY_BUFFER, self._id)
+        return util.OptionalContextManager(lambda: None)
+
+
+class IndexBuffer(object):
+    def __init__(self):
+        self._id = GL.glGenBuffers(1)
+        tracker.track(self, 'buffer', self._id)
+
+    def bind(self):
+        """Bind the index buffer.
+
+        The binding is part of the vertex array state, so this should be called
+        with the vertex array bound, and is not undone."""
+        state.bind_buffer(GL.GL_ELEMENT_ARRAY_BUFFER, self._id)
+
+
+class StreamBuffer(object):
+    """A buffer for data which is rewritten every frame.
+
+    The buffer is split into SEGMENTS segments, used in turn by successive
+    frames, so the data for a frame is written while the GPU is still
+    reading that of the frames before it. A fence is placed after each
+    frame's draws, and a segment is only reused once the fence for its
+    last use has been passed. Data is written through a NumPy view of the
+    mapped segment, without synchronising with the GPU.
+
+    Where sync objects or buffer mapping are unavailable, the buffer falls
+    back to appending data with glBufferSubData, orphaning the storage when
+    it fills up."""
+    SEGMENTS = 3
+
+    # How long to wait for a fence before checking again, in nanoseconds.
+    _FENCE_TIMEOUT = 1000000
+
+    def __init__(self, target, segment_bytes):
+        self._target = target
+        self._id = GL.glGenBuffers(1)
+        tracker.track(self, 'buffer', self._id)
+        self._synced = bool(GL.glFenceSync) and bool(GL.glMapBufferRange)
+        self._fences = [None] * StreamBuffer.SEGMENTS
+        self._segment = 0
+        self._frame = state.frame
+        self._allocate(segment_bytes)
+
+    def _allocate(self, segment_bytes):
+        """Allocate new storage for the buffer, orphaning the old storage."""
+        for fence in self._fences:
+            if fence is not None:
+                GL.glDeleteSync(fence)
+        self._fences = [None] * StreamBuffer.SEGMENTS
+        self._segment_bytes = segment_bytes
+        self._segment = 0
+        self._offset = 0
+
+        size = segment_bytes
+        if self._synced:
+            size *= StreamBuffer.SEGMENTS
+        self.bind()
+        buffer_data(self._target, size, None, GL.GL_STREAM_DRAW)
+
+    @property
+    def id(self):
+        return self._id
+
+    def bind(self):
+        state.bind_buffer(self._target, self._id)
+
+    def _next_segment(self):
+        """Fence the current segment, and move on to the next one."""
+        self._fences[self._segment] = GL.glFenceSync(
+            GL.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self._segment = (self._segment + 1) % StreamBuffer.SEGMENTS
+        self._offset = self._segment * self._segment_bytes
+
+        fence = self._fences[self._segment]
+        if fence is not None:
+            while GL.glClientWaitSync(
+                    fence, GL.GL_SYNC_FLUSH_COMMANDS_BIT,
+                    StreamBuffer._FENCE_TIMEOUT) == GL.GL_TIMEOUT_EXPIRED:
+                pass
+            GL.glDeleteSync(fence)
+            self._fences[self._segment] = None
+
+    @contextmanager
+    def map(self, dtype, count):
+        """Map space for an array of count elements of dtype.
+
+        Yields a NumPy view of the space, to be filled in, and the byte offset
+        of the space in the buffer. The offset is a multiple of the element
+        size. The buffer is bound, and is left bound. The data is only valid
+        until the end of the frame, so must be drawn in the frame it is
+        written in."""
+        dtype = numpy.dtype(dtype)
+        nbytes = dtype.itemsize * count
+        if self._frame != state.frame:
+            self._frame = state.frame
+            if self._synced:
+                self._next_segment()
+
+        offset = -(-self._offset // dtype.itemsize) * dtype.itemsize
+        end = self._segment_bytes
+        if self._synced:
+            end *= self._segment + 1
+        if offset + nbytes > end:
+            # Orphan the storage rather than waiting for the GPU, growing it
+            # if the data doesn't fit in a segment.
+            if nbytes > self._segment_bytes:
+                self._allocate(max(nbytes, self._segment_bytes * 2))
+            else:
+                self._allocate(self._segment_bytes)
+            offset = 0
+
+        self.bind()
+        self._offset = offset + nbytes
+        if not self._synced:
+            data = numpy.empty(count, dtype)
+            yield data, offset
+            GL.glBufferSubData(self._target, offset, nbytes, data)
+            return
+
+        pointer = GL.glMapBufferRange(
+            self._target, offset, nbytes,
+            GL.GL_MAP_WRITE_BIT | GL.GL_MAP_INVALIDATE_RANGE_BIT |
+            GL.GL_MAP_UNSYNCHRONIZED_BIT)
+        memory = (ctypes.c_ubyte * nbytes).from_address(pointer)
+        try:
+            yield numpy.frombuffer(memory, dtype, count), offset
+        finally:
+            GL.glUnmapBuffer(self._target)
+
+    def write(self, data):
+        """Write an array to the buffer.
+
+        Returns the byte offset of the data in the buffer."""
+        with self.map(data.dtype, len(data)) as (view, offset):
+            view[...] = data
+        return offset
 
 
 class ShaderInstance(object):
@@ -71,23 +390,19 @@ class ShaderInstance(object):
         for uniform in uniforms:
             self._uniform_cache_add(uniform[0], uniform[1], uniform[2])
 
+    @property
+    def program(self):
+        """The GL id of the shader program."""
+        return self._program.program
+
     def _uniform_cache_add(self, name, gl_type, value):
         self._uniforms[name] = (self._program.uniform(name), gl_type, value)
 
     def _dl_uniform(self, info):
-        """Download a uniform value to the shader."""
+        """Download a uniform value to the shader, if it has changed."""
         uniform, gl_type, value = info
-
-        if gl_type == GL.GL_INT:
-            GL.glUniform1i(uniform, value)
-        elif gl_type == GL.GL_FLOAT_VEC2:
-            GL.glUniform2f(uniform, value[0], value[1])
-        elif gl_type == GL.GL_FLOAT_VEC3:
-            GL.glUniform3f(uniform, value[0], value[1], value[2])
-        elif gl_type == GL.GL_FLOAT_VEC4:
-            GL.glUniform4f(uniform, value[0], value[1], value[2], value[3])
-        elif gl_type == GL.GL_FLOAT_MAT4:
-            GL.glUniformMatrix4fv(uniform, 1, GL.GL_TRUE, value)
+        if value is not None:
+            state.uniform(uniform, gl_type, value)
 
     def set_uniform(self, name, value=None, download=True):
         """Set a uniform, optionally updating its value first.
@@ -102,20 +417,141 @@ class ShaderInstance(object):
             self._dl_uniform(self._uniforms[name])
 
     def use(self, download_uniforms=True):
+        """Use the program, downloading any uniforms which have changed."""
         self._program.use()
         if download_uniforms:
             for uniform_info in self._uniforms.values():
                 self._dl_uniform(uniform_info)
-        return util.OptionalContextManager(lambda: GL.glUseProgram(0))
+        return util.OptionalContextManager(lambda: None)
+
+
+class CameraBuffer(object):
+    """A uniform buffer holding the camera's matrices.
+
+    The buffer is bound to the uniform block binding point of the Camera
+    block, which is shared by all the shaders that draw the level. The
+    camera is uploaded at most once per frame, and only when it has moved,
+    however many draws use it.
+
+    The screen dimensions in the block are those of the render target,
+    which may be smaller than the window, as set by set_resolution."""
+
+    def __init__(self):
+        self._id = GL.glGenBuffers(1)
+        tracker.track(self, 'buffer', self._id)
+        self._version = None
+        self._camera = None
+        self._resolution = None
+
+        # The block holds the view, projection and combined matrices,
+        # followed by the screen dimensions and pixel scale, using the std140
+        # layout.
+        self._data = numpy.zeros(52, numpy.float32)
+        state.bind_buffer(GL.GL_UNIFORM_BUFFER, self._id)
+        buffer_data(GL.GL_UNIFORM_BUFFER, self._data.nbytes, None,
+                    GL.GL_DYNAMIC_DRAW)
+        GL.glBindBufferBase(GL.GL_UNIFORM_BUFFER, UNIFORM_BLOCKS['Camera'],
+                            self._id)
+
+    def set_resolution(self, width, height, scale):
+        """Set the size of the render target, and its scale relative to the
+        window."""
+        if (width, height, scale) != self._resolution:
+            self._resolution = (width, height, scale)
+            # Upload on the next update.
+            self._camera = None
+
+    def update(self, cam):
+        """Upload the camera's matrices, if they have changed."""
+        if cam.version == self._version and self._camera is cam:
+            return
+        self._version = cam.version
+        self._camera = cam
+
+        self._data[0:16] = numpy.asarray(cam.cam_matrix).reshape(-1)
+        self._data[16:32] = numpy.asarray(cam.proj_matrix).reshape(-1)
+        self._data[32:48] = numpy.asarray(cam.trans_matrix).reshape(-1)
+        if self._resolution is None:
+            self._data[48:51] = (cam.screen_width, cam.screen_height, 1)
+        else:
+            self._data[48:51] = self._resolution
+        state.bind_buffer(GL.GL_UNIFORM_BUFFER, self._id)
+        GL.glBufferSubData(GL.GL_UNIFORM_BUFFER, 0, self._data.nbytes,
+                           self._data)
+
+
+class SceneBuffer(object):
+    """An offscreen framebuffer for drawing the scene at a reduced
+    resolution, to be scaled up to the window.
+
+    The storage is allocated at the full size of the window, and the scene is
+    drawn into its bottom left corner, so the resolution can change without
+    reallocating it."""
+    def __init__(self, window_width, window_height):
+        self._window_width = window_width
+        self._window_height = window_height
+        self._framebuf = GL.glGenFramebuffers(1)
+        tracker.track(self, 'framebuffer', self._framebuf)
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self._framebuf)
+
+        self._colourbuf = GL.glGenRenderbuffers(1)
+        tracker.track(self, 'renderbuffer', self._colourbuf,
+                      window_width * window_height * 4)
+        GL.glBindRenderbuffer(GL.GL_RENDERBUFFER, self._colourbuf)
+        GL.glRenderbufferStorage(GL.GL_RENDERBUFFER, GL.GL_RGBA8,
+                                 window_width, window_height)
+        GL.glFramebufferRenderbuffer(GL.GL_FRAMEBUFFER,
+                                     GL.GL_COLOR_ATTACHMENT0,
+                                     GL.GL_RENDERBUFFER, self._colourbuf)
+
+        self._depthbuf = GL.glGenRenderbuffers(1)
+        tracker.track(self, 'renderbuffer', self._depthbuf,
+                      window_width * window_height * 4)
+        GL.glBindRenderbuffer(GL.GL_RENDERBUFFER, self._depthbuf)
+        GL.glRenderbufferStorage(GL.GL_RENDERBUFFER, GL.GL_DEPTH24_STENCIL8,
+                                 window_width, window_height)
+        GL.glFramebufferRenderbuffer(GL.GL_FRAMEBUFFER,
+                                     GL.GL_DEPTH_STENCIL_ATTACHMENT,
+                                     GL.GL_RENDERBUFFER, self._depthbuf)
+
+        if (GL.glCheckFramebufferStatus(GL.GL_FRAMEBUFFER) !=
+                GL.GL_FRAMEBUFFER_COMPLETE):
+            raise RuntimeError('Scene framebuffer is incomplete')
+
+        # Restore the default framebuffer
+        GL.glBindRenderbuffer(GL.GL_RENDERBUFFER, 0)
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, 0)
+
+    @contextmanager
+    def enable(self, width, height):
+        """Draw to a width by height area of the buffer."""
+        GL.glBindFramebuffer(GL.GL_DRAW_FRAMEBUFFER, self._framebuf)
+        GL.glViewport(0, 0, width, height)
+        try:
+            yield
+        finally:
+            GL.glBindFramebuffer(GL.GL_DRAW_FRAMEBUFFER, 0)
+            GL.glViewport(0, 0, self._window_width, self._window_height)
+
+    def blit(self, width, height):
+        """Scale a width by height area of the buffer up to the window."""
+        GL.glBindFramebuffer(GL.GL_READ_FRAMEBUFFER, self._framebuf)
+        GL.glBlitFramebuffer(0, 0, width, height,
+                             0, 0, self._window_width, self._window_height,
+                             GL.GL_COLOR_BUFFER_BIT, GL.GL_LINEAR)
+        GL.glBindFramebuffer(GL.GL_READ_FRAMEBUFFER, 0)
 
 
 class PickingTexture(object):
     def __init__(self, window_width, window_height):
         self._framebuf = GL.glGenFramebuffers(1)
+        tracker.track(self, 'framebuffer', self._framebuf)
         GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self._framebuf)
 
         self._picktex = GL.glGenTextures(1)
-        GL.glBindTexture(GL.GL_TEXTURE_2D, self._picktex)
+        tracker.track(self, 'texture', self._picktex,
+                      window_width * window_height * 16)
+        state.bind_texture(self._picktex)
         GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGBA32F,
                         window_width, window_height, 0, GL.GL_RGB, GL.GL_FLOAT,
                         None)
@@ -124,7 +560,9 @@ class PickingTexture(object):
                                   self._picktex, 0)
 
         self._depthtex = GL.glGenTextures(1)
-        GL.glBindTexture(GL.GL_TEXTURE_2D, self._depthtex)
+        tracker.track(self, 'texture', self._depthtex,
+                      window_width * window_height * 4)
+        state.bind_texture(self._depthtex)
         GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_DEPTH_COMPONENT,
                         window_width, window_height, 0, GL.GL_DEPTH_COMPONENT,
                         GL.GL_FLOAT, None)
@@ -137,7 +575,6 @@ class PickingTexture(object):
         GL.glDrawBuffer(GL.GL_COLOR_ATTACHMENT0)
 
         # Restore the default framebuffer
-        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
         GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, 0)
 
     @contextmanager
@@ -159,36 +596,32 @@ class PickingTexture(object):
 
 
 class Hex(object):
-    def __init__(self, coords, size, depth, stacks=1):
+    """The mesh of a column of hex stacks, standing on the origin.
+
+    Hexes are shared between everything with the same shape, so rather than
+    constructing them directly, use cached_hex. Objects are placed in the
+    world with a model transform."""
+    def __init__(self, size, depth, stacks=1):
         self._stacks = stacks
 
         # The top layer of the tile is drawn with a line loop.
         # The vertical sections are drawn with lines.
-        all_verts = []
-        for s in range(self._stacks):
-            top_verts, vert_verts = ([], [])
-            for i in range(6):
-                z = coords.z + depth * s
-                px = coords.x + size * math.sin((2 * math.pi / 6) * (5 - i))
-                py = coords.y + size * math.cos((2 * math.pi / 6) * (5 - i))
-                top_verts.extend([px, py, z + depth])
-
-                px = coords.x + size * math.sin((2 * math.pi / 6) * i)
-                py = coords.y + size * math.cos((2 * math.pi / 6) * i)
-                vert_verts.extend([px, py, z, px, py, z + depth])
-            all_verts.extend(top_verts + vert_verts)
-
-        verts = numpy.array(all_verts, numpy.float32)
+        verts = mesh.hex_stacks(numpy.zeros(3, numpy.float32),
+                                size, depth, stacks)
 
         self._vao = VertexArray()
         self._vbo = VertexBuffer()
         with self._vao.bind():
             self._vbo.bind()
-            GL.glBufferData(GL.GL_ARRAY_BUFFER, verts.nbytes, verts,
-                            GL.GL_STATIC_DRAW)
+            buffer_data(GL.GL_ARRAY_BUFFER, verts.nbytes, verts,
+                        GL.GL_STATIC_DRAW)
             GL.glEnableVertexAttribArray(0)
             GL.glVertexAttribPointer(0, 3, GL.GL_FLOAT, GL.GL_FALSE, 0, None)
 
+    @property
+    def vertex_array(self):
+        return self._vao
+
     def draw_faces(self):
         with self._vao.bind():
             for s in range(self._stacks):
@@ -206,3 +639,230 @@ class Hex(object):
             self.draw_outline()
         if faces:
             self.draw_faces()
+
+
+# Hex meshes, keyed by (size, depth, stacks).
+_hex_cache = {}
+
+
+def cached_hex(size, depth, stacks=1):
+    """Get the shared Hex with the given shape, building it if needed."""
+    key = (size, depth, stacks)
+    if key not in _hex_cache:
+        _hex_cache[key] = Hex(size, depth, stacks)
+    return _hex_cache[key]
+
+
+class ThickLines(object):
+    """Draws line segments of any width.
+
+    glLineWidth only supports a width of 1 in the core profile, so each
+    segment is drawn as an instance of a quad, which the vertex shader
+    expands to the line width in screen space.
+
+    Segments are uploaded in groups, each with its own range of a shared
+    buffer, so that one group can be replaced without uploading the others
+    and only some of the groups need be drawn. Ranges are given some slack
+    so that a group can usually be replaced in place. Otherwise it is moved
+    to the end of the buffer, which is grown and compacted when full."""
+    # Segments hold their start and end points and a normalised RGBA colour.
+    _SEGMENT = numpy.dtype([('start', numpy.float32, 3),
+                            ('end', numpy.float32, 3),
+                            ('colour', numpy.uint8, 4)])
+
+    # The initial capacity of the buffer, in segments.
+    CAPACITY = 4096
+
+    # The extra room given to each range, as a fraction of its segments.
+    SLACK = 0.25
+
+    def __init__(self, app, width):
+        self._shader = ShaderInstance(app, 'thick_line.vs', 'level2.fs',
+                                      [('lineWidth', GL.GL_FLOAT, width)])
+
+        # The first segment, capacity and number of segments of the range of
+        # each group, keyed by group.
+        self._ranges = {}
+        self._end = 0
+        self._capacity = ThickLines.CAPACITY
+
+        self._vao = VertexArray()
+        self._vbo = VertexBuffer()
+        self._vbo.bind()
+        buffer_data(GL.GL_ARRAY_BUFFER,
+                    self._capacity * ThickLines._SEGMENT.itemsize, None,
+                    GL.GL_DYNAMIC_DRAW)
+        with self._vao.bind():
+            for attribute in range(3):
+                GL.glEnableVertexAttribArray(attribute)
+                GL.glVertexAttribDivisor(attribute, 1)
+
+    @property
+    def program(self):
+        return self._shader.program
+
+    @property
+    def vertex_array(self):
+        return self._vao
+
+    def _point_attributes(self, offset):
+        """Point the attributes at segments starting at a byte offset in the
+        buffer, which must be bound along with the vertex array."""
+        stride = ThickLines._SEGMENT.itemsize
+        GL.glVertexAttribPointer(0, 3, GL.GL_FLOAT, GL.GL_FALSE, stride,
+                                 ctypes.c_void_p(offset))
+        GL.glVertexAttribPointer(1, 3, GL.GL_FLOAT, GL.GL_FALSE, stride,
+                                 ctypes.c_void_p(offset + 12))
+        GL.glVertexAttribPointer(2, 4, GL.GL_UNSIGNED_BYTE, GL.GL_TRUE,
+                                 stride, ctypes.c_void_p(offset + 24))
+
+    def _allocate(self, count):
+        """Find room for count segments at the end of the buffer."""
+        if self._end + count > self._capacity:
+            self._grow(count)
+        first = self._end
+        self._end += count
+        return first
+
+    def _grow(self, count):
+        """Copy the ranges into a new buffer with room for count more
+        segments, leaving out the unused space between them."""
+        itemsize = ThickLines._SEGMENT.itemsize
+        live = sum(capacity for _, capacity, _ in self._ranges.values())
+        self._capacity = max(ThickLines.CAPACITY, 2 * (live + count))
+
+        vbo = VertexBuffer()
+        state.bind_buffer(GL.GL_COPY_WRITE_BUFFER, vbo.id)
+        buffer_data(GL.GL_COPY_WRITE_BUFFER, self._capacity * itemsize, None,
+                    GL.GL_DYNAMIC_DRAW)
+        state.bind_buffer(GL.GL_COPY_READ_BUFFER, self._vbo.id)
+        self._end = 0
+        for key, (first, capacity, used) in sorted(self._ranges.items(),
+                                                   key=lambda r: r[1][0]):
+            if used:
+                GL.glCopyBufferSubData(GL.GL_COPY_READ_BUFFER,
+                                       GL.GL_COPY_WRITE_BUFFER,
+                                       first * itemsize,
+                                       self._end * itemsize,
+                                       used * itemsize)
+            self._ranges[key] = (self._end, capacity, used)
+            self._end += capacity
+        self._vbo = vbo
+
+    def upload(self, key, starts, ends, colours):
+        """Replace the segments of a group.
+
+        starts and ends are (n, 3) arrays of the ends of the segments, and
+        colours is an (n, 4) array of RGBA colours from 0 to 1."""
+        segments = numpy.empty(len(starts), ThickLines._SEGMENT)
+        segments['start'] = starts
+        segments['end'] = ends
+        segments['colour'] = numpy.round(numpy.asarray(colours) * 255)
+
+        first, capacity, _ = self._ranges.pop(key, (0, 0, 0))
+        if len(segments) > capacity:
+            capacity = len(segments) + int(len(segments) * ThickLines.SLACK)
+            first = self._allocate(capacity)
+        self._ranges[key] = (first, capacity, len(segments))
+
+        if len(segments):
+            self._vbo.bind()
+            GL.glBufferSubData(GL.GL_ARRAY_BUFFER,
+                               first * ThickLines._SEGMENT.itemsize,
+                               segments.nbytes, segments)
+
+    def remove(self, key):
+        """Remove the segments of a group."""
+        self._ranges.pop(key, None)
+
+    def draw(self, keys):
+        """Draw the segments of some groups.
+
+        Groups whose ranges are next to each other are drawn together."""
+        runs = []
+        for first, _, count in sorted(self._ranges[key] for key in keys
+                                      if key in self._ranges):
+            if runs and runs[-1][0] + runs[-1][1] == first:
+                runs[-1][1] += count
+            elif count:
+                runs.append([first, count])
+        if not runs:
+            return
+
+        with self._shader.use(), self._vao.bind():
+            self._vbo.bind()
+            for first, count in runs:
+                self._point_attributes(first * ThickLines._SEGMENT.itemsize)
+                GL.glDrawArraysInstanced(GL.GL_TRIANGLE_STRIP, 0, 4, count)
+
+
+class HexInstances(object):
+    """Draws many copies of a hex column with a single draw call.
+
+    The column mesh is shared by all the instances, and each instance has its
+    own offset and colour, streamed to the GPU every frame."""
+    # The initial capacity of the instance buffer, in instances per frame.
+    CAPACITY = 256
+
+    def __init__(self, app, size, depth, stacks=1):
+        self._shader = ShaderInstance(app, 'instanced.vs', 'level2.fs', [])
+
+        verts = mesh.hex_column_triangles(size, depth * stacks)
+        self._vertex_count = len(verts)
+
+        self._vao = VertexArray()
+        self._vbo = VertexBuffer()
+        self._instance_vbo = StreamBuffer(GL.GL_ARRAY_BUFFER,
+                                          HexInstances.CAPACITY * 7 * 4)
+        with self._vao.bind():
+            self._vbo.bind()
+            buffer_data(GL.GL_ARRAY_BUFFER, verts.nbytes, verts,
+                        GL.GL_STATIC_DRAW)
+            GL.glEnableVertexAttribArray(0)
+            GL.glVertexAttribPointer(0, 3, GL.GL_FLOAT, GL.GL_FALSE, 0, None)
+
+            # Per-instance offset and colour. Attribute divisors need
+            # ARB_instanced_arrays, which is core from 3.3.
+            self._instance_vbo.bind()
+            GL.glEnableVertexAttribArray(1)
+            GL.glVertexAttribDivisor(1, 1)
+            GL.glEnableVertexAttribArray(2)
+            GL.glVertexAttribDivisor(2, 1)
+            HexInstances._point_attributes(0)
+
+    @staticmethod
+    def _point_attributes(offset):
+        """Point the instance attributes at instances starting at a byte
+        offset in the instance buffer, which must be bound along with the
+        vertex array."""
+        GL.glVertexAttribPointer(1, 3, GL.GL_FLOAT, GL.GL_FALSE, 7 * 4,
+                                 ctypes.c_void_p(offset))
+        GL.glVertexAttribPointer(2, 4, GL.GL_FLOAT, GL.GL_FALSE, 7 * 4,
+                                 ctypes.c_void_p(offset + 12))
+
+    def draw(self, queue, instances, render_pass=render.RenderQueue.OPAQUE):
+        """Submit the instances to a render queue.
+
+        instances is a sequence containing a 7-tuple for each instance: the
+        x, y and z offset of the instance, followed by its RGBA colour."""
+        if len(instances) == 0:
+            return
+        queue.submit(render_pass, self._shader.program, self._vao.id,
+                     self._draw, numpy.array(instances, numpy.float32))
+
+    def _draw(self, batches):
+        """Draw the batches of instances submitted to the queue."""
+        count = sum(len(batch) for batch in batches)
+        with self._vao.bind():
+            with self._instance_vbo.map(numpy.float32, count * 7) as (
+                    data, offset):
+                data = data.reshape(count, 7)
+                start = 0
+                for batch in batches:
+                    data[start:start + len(batch)] = batch
+                    start += len(batch)
+            HexInstances._point_attributes(offset)
+
+            with self._shader.use():
+                GL.glDrawArraysInstanced(GL.GL_TRIANGLES, 0,
+                                         self._vertex_count, count)
@@ -1,10 +1,12 @@
 """Module for the in-game HUD."""
+import collections
 from enum import Enum, unique
 import numpy
 import OpenGL.GL as GL
 import typingdefense.tower as tower
 import typingdefense.text as text
 import typingdefense.glutils as glutils
+import typingdefense.render as render
 import typingdefense.level
 
 
@@ -32,20 +34,23 @@ class Button(object):
         with self._vao.bind():
             self._vbo.bind()
             data_array = numpy.array(data, numpy.float32)
-            GL.glBufferData(GL.GL_ARRAY_BUFFER,
-                            data_array.nbytes, data_array,
-                            GL.GL_STATIC_DRAW)
+            glutils.buffer_data(GL.GL_ARRAY_BUFFER,
+                                data_array.nbytes, data_array,
+                                GL.GL_STATIC_DRAW)
             GL.glEnableVertexAttribArray(0)
             GL.glVertexAttribPointer(0, 2, GL.GL_FLOAT, GL.GL_FALSE, 8, None)
 
-    def draw(self, translate=None):
-        if translate is not None:
-            self._shader.set_uniform('translate', translate, download=False)
-        else:
-            self._shader.set_uniform('translate', [0, 0], download=False)
-
-        with self._shader.use():
-            with self._vao.bind():
+    def draw(self, queue, translate=None):
+        queue.submit(render.RenderQueue.HUD, self._shader.program,
+                     self._vao.id, self._draw, translate)
+
+    def _draw(self, translates):
+        with self._shader.use(download_uniforms=False), self._vao.bind():
+            for translate in translates:
+                if translate is None:
+                    translate = [0, 0]
+                self._shader.set_uniform('translate', translate)
+                self._shader.set_uniform('screenDimensions')
                 GL.glDrawArrays(GL.GL_LINE_LOOP, 0, 4)
 
     def hit(self, x, y):
@@ -66,34 +71,48 @@ class Hud(object):
 
     _ANIMATION_TIME = 0.5
 
+    # Whether to show, under the FPS counter, the GL calls made and skipped by
+    # glutils.state in each frame, by kind.
+    SHOW_GL_STATS = False
+
     def __init__(self, app, level):
-        font = app.resources.load_font('hudfont.fnt')
+        self._app = app
+        self._font = app.resources.load_font('hudfont.fnt')
+        self._text = app.text_batch
         self._level = level
         self._animation_change_time = 0
         self._animation_state = Hud.AnimationState.none
 
-        self._money = text.Text2D(app, font, str(level.money),
-                                  app.window_width / 2, app.window_height - 32,
-                                  32, text.Text.Align.center)
+        self._money_pos = (app.window_width / 2, app.window_height - 32)
 
         self._play_button = Button(app, 20, 20)
         self._slow_tower_button = Button(app, 70, 20)
         self._kill_tower_button = Button(app, 120, 20)
         self._money_tower_button = Button(app, 170, 20)
 
-        self._fps = text.Text2D(app, font, '', 0, app.window_height - 32, 32)
+        self._fps_pos = (0, app.window_height - 32)
 
         self._frametime = 0
+        self._gl_calls = collections.Counter()
+        self._gl_avoided = collections.Counter()
 
-    def draw(self):
-        # Smooth the FPS counter
+    def draw(self, queue):
+        # Smooth the FPS counter. The frame time only counts the time spent
+        # on frames, not waiting for events while nothing changes, so this
+        # shows the rate the game could draw at.
         if self._frametime == 0:
-            self._frametime = self._level.timer.frametime
+            self._frametime = self._app.frametime
         else:
             self._frametime = (self._frametime * 0.95 +
-                               self._level.timer.frametime * 0.05)
-        self._fps.draw(str(round(1 / self._frametime)))
-        self._money.draw(str(self._level.money))
+                               self._app.frametime * 0.05)
+        if self._frametime > 0:
+            self._text.add(self._font, str(round(1 / self._frametime)),
+                           self._fps_pos[0], self._fps_pos[1], 32)
+        self._text.add(self._font, str(self._level.money),
+                       self._money_pos[0], self._money_pos[1], 32,
+                       text.Align.center)
+        if Hud.SHOW_GL_STATS:
+            self._draw_gl_stats()
 
         if (self._animation_state != Hud.AnimationState.none and
                 self._level.timer.time - Hud._ANIMATION_TIME >
@@ -115,10 +134,30 @@ class Hud(object):
 
         if (self._animation_state != Hud.AnimationState.none or
                 self._level.state == typingdefense.level.Level.State.build):
-            self._play_button.draw(translate)
-            self._slow_tower_button.draw(translate)
-            self._kill_tower_button.draw(translate)
-            self._money_tower_button.draw(translate)
+            self._play_button.draw(queue, translate)
+            self._slow_tower_button.draw(queue, translate)
+            self._kill_tower_button.draw(queue, translate)
+            self._money_tower_button.draw(queue, translate)
+
+    def _draw_gl_stats(self):
+        """Show the GL calls made and avoided since the last draw."""
+        calls = glutils.state.calls - self._gl_calls
+        avoided = glutils.state.avoided - self._gl_avoided
+        self._gl_calls = glutils.state.calls.copy()
+        self._gl_avoided = glutils.state.avoided.copy()
+
+        x, y = self._fps_pos
+        for kind in sorted(set(self._gl_calls) | set(self._gl_avoided)):
+            y -= 32
+            self._text.add(self._font,
+                           '{} {}/{}'.format(kind.upper(), calls[kind],
+                                             avoided[kind]),
+                           x, y, 32)
+
+    @property
+    def animating(self):
+        """Whether the HUD is animating, so needs redrawing every frame."""
+        return self._animation_state != Hud.AnimationState.none
 
     def on_click(self, x, y):
         if self._play_button.hit(x, y):
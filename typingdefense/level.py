@@ -4,17 +4,30 @@ import numpy
 import weakref
 import json
 import copy
-import ctypes
+import sdl2
 from collections import deque
 from enum import Enum, unique
 from OpenGL import GL
 import typingdefense.glutils as glutils
+import typingdefense.mesh as mesh
 import typingdefense.camera as camera
 import typingdefense.vector as vector
 import typingdefense.enemy as enemy
+import typingdefense.tower as tower
 import typingdefense.util as util
 import typingdefense.hud as hud
+import typingdefense.terrain as terrain
+import typingdefense.phrase as phrase
 import typingdefense.phrasebook as phrasebook
+import typingdefense.render as render
+
+
+# The edges of a hex, as pairs of their outward normal in the x-y plane and
+# the axial direction of the neighbour beyond the edge, clockwise from the
+# top right, in the same order as the sides of the terrain mesh.
+_HEX_EDGES = [((math.sin(math.radians(60 * i + 30)),
+                math.cos(math.radians(60 * i + 30))), d)
+              for i, d in enumerate(mesh.SIDE_DIRECTIONS)]
 
 
 def _cube_round(fc):
@@ -61,7 +74,7 @@ class Tile(object):
     VERT_SPACING = HEIGHT * 0.75
     HORIZ_SPACING = WIDTH
 
-    def __init__(self, app, cam, coords, height, colour):
+    def __init__(self, app, coords, height, colour):
         """Construct a (hexagonal) tile.
 
         coords is a vector containing the horizontal coordinates of the tile,
@@ -74,12 +87,13 @@ class Tile(object):
         self.path_next = None
         self.tower = None
 
+        self.model_matrix = util.Transform(
+            vector.Vector(self.x, self.y, 0)).as_array()
         self._shader = glutils.ShaderInstance(
             app, 'level.vs', 'level.fs',
-            [('transMatrix', GL.GL_FLOAT_MAT4, cam.trans_matrix_as_array()),
+            [('modelMatrix', GL.GL_FLOAT_MAT4, self.model_matrix),
              ('colourIn', GL.GL_FLOAT_VEC4, None)])
-        self._hex = glutils.Hex(vector.Vector(self.x, self.y, 0),
-                                Tile.SIZE, Tile.DEPTH, height)
+        self._hex = glutils.cached_hex(Tile.SIZE, Tile.DEPTH, height)
 
         self.outline_colour = colour
         self.face_colour = copy.copy(self.outline_colour)
@@ -130,11 +144,22 @@ class Tile(object):
         """Indicate whether the tile has a tower on it."""
         return self.tower is None
 
-    def draw(self, outline=True, faces=True,
+    def draw(self, queue, outline=True, faces=True,
              outline_colour=None, face_colour=None):
-        """Draw the tile."""
+        """Submit the tile to a render queue."""
+        queue.submit(render.RenderQueue.OPAQUE, self._shader.program,
+                     self._hex.vertex_array.id, Tile._draw_tiles,
+                     (self, outline, faces, outline_colour, face_colour))
+
+    @staticmethod
+    def _draw_tiles(tiles):
+        """Draw a batch of tiles submitted to the render queue."""
+        for tile, outline, faces, outline_colour, face_colour in tiles:
+            tile._draw(outline, faces, outline_colour, face_colour)
+
+    def _draw(self, outline, faces, outline_colour, face_colour):
         with self._shader.use(download_uniforms=False):
-            self._shader.set_uniform('transMatrix')
+            self._shader.set_uniform('modelMatrix')
             if faces:
                 if face_colour is None:
                     self._shader.set_uniform('colourIn', self.face_colour)
@@ -146,15 +171,15 @@ class Tile(object):
                 if outline_colour is None:
                     self._shader.set_uniform('colourIn', self.outline_colour)
                 else:
-                    self._shader.set_uniform('colourIn', outline)
-                with glutils.linewidth(2):
-                    self._hex.draw_outline()
+                    self._shader.set_uniform('colourIn', outline_colour)
+                self._hex.draw_outline()
 
     def picking_draw(self, picking_shader):
         """Draw to the picking framebuffer.
 
         This allows us to determine which tile was hit by mouse events.
         """
+        picking_shader.set_uniform('modelMatrix', self.model_matrix)
         picking_shader.set_uniform('colourIn',
                                    [self.coords.q, self.coords.r, 0, 0])
         self._hex.draw_faces()
@@ -164,18 +189,22 @@ class Base(object):
     """Class representing the player's base."""
     START_HEALTH = 100
 
-    def __init__(self, app, cam, tile, origin, z):
+    def __init__(self, app, tile, origin, z):
         self.health = Base.START_HEALTH
         self.tile = tile
 
         self._shader = glutils.ShaderInstance(
             app, 'level.vs', 'level.fs',
-            [('transMatrix', GL.GL_FLOAT_MAT4, cam.trans_matrix_as_array())])
-        self._hex = glutils.Hex(vector.Vector(tile.x, tile.y, 0),
-                                Tile.SIZE * 0.8, Tile.DEPTH, 2)
+            [('modelMatrix', GL.GL_FLOAT_MAT4,
+              util.Transform(vector.Vector(tile.x, tile.y, 0)).as_array())])
+        self._hex = glutils.cached_hex(Tile.SIZE * 0.8, Tile.DEPTH, 2)
 
-    def draw(self):
-        """Draw the base."""
+    def draw(self, queue):
+        """Submit the base to a render queue."""
+        queue.submit(render.RenderQueue.OPAQUE, self._shader.program,
+                     self._hex.vertex_array.id, self._draw)
+
+    def _draw(self, _):
         with self._shader.use():
             self._hex.draw()
 
@@ -193,13 +222,32 @@ class Level(object):
         defend = 1
         build = 2
 
+    # Camera movement for each arrow key press, and zoom for each scroll step.
+    _PAN_STEP = 2
+    _PAN_DIRECTIONS = {sdl2.SDLK_LEFT: (-1, 0),
+                       sdl2.SDLK_RIGHT: (1, 0),
+                       sdl2.SDLK_UP: (0, 1),
+                       sdl2.SDLK_DOWN: (0, -1)}
+    _ZOOM_STEP = 0.9
+
+    # Radii of spheres around the origins of enemies and towers, which
+    # contain their hexes, for culling. Phrases are culled separately, by the
+    # extent of their text on the screen.
+    _ENEMY_RADIUS = Tile.SIZE * 2
+    _TOWER_RADIUS = tower._BaseTower.DEPTH * tower._BaseTower.STACKS
+
+    # Whether to pick tiles by reading back a buffer of rendered tile
+    # coordinates, rather than by casting rays on the CPU.
+    PICKING_BUFFER = False
+
     def __init__(self, app, game):
         self._app = app
         self.cam = camera.Camera(
             origin=[0, -30, 60], target=[0, 0, 0], up=[0, 1, 0], fov=50,
             screen_width=app.window_width, screen_height=app.window_height,
             near=0.1, far=1000)
-        self.phrases = phrasebook.PhraseBook('resources/phrases/all.phr')
+        self.phrases = phrasebook.PhraseBook(
+            app.phrasebooks.load(phrasebook.Registry.DEFAULT_DICTIONARY))
 
         # Level state
         self.timer = util.Timer()
@@ -212,6 +260,10 @@ class Level(object):
         self.waves = []
         self.tower_creator = None
 
+        # Set whenever something visible changes, and cleared by the app
+        # when it redraws the level.
+        self.dirty = True
+
         # Map/graphics etc.
         self._min_coords = None
         self._max_coords = None
@@ -219,22 +271,26 @@ class Level(object):
         self.base = None
         self.load()
 
-        self._vao = None
-        self._vbo = None
-        self._shader = glutils.ShaderInstance(
-            self._app, 'level2.vs', 'level2.fs',
-            [('transMatrix', GL.GL_FLOAT_MAT4,
-              self.cam.trans_matrix_as_array()),
-             ('colourIn', GL.GL_FLOAT_VEC4, [1, 1, 1, 1])])
-        self._build_vertex_arrays()
-
-        self._picking_texture = glutils.PickingTexture(app.window_width,
-                                                       app.window_height)
-        self._picking_shader = glutils.ShaderInstance(
-            app, 'level.vs', 'picking.fs',
-            [['transMatrix', GL.GL_FLOAT_MAT4,
-              self.cam.trans_matrix_as_array()],
-             ['colourIn', GL.GL_FLOAT_VEC4, [0, 0, 0, 0]]])
+        self.terrain = terrain.Terrain(app, self, Tile.SIZE, Tile.DEPTH)
+
+        self._enemy_instances = glutils.HexInstances(
+            app, enemy._BaseEnemy.SIZE, enemy._BaseEnemy.DEPTH)
+        self._tower_instances = glutils.HexInstances(
+            app, tower._BaseTower.SIZE, tower._BaseTower.DEPTH,
+            tower._BaseTower.STACKS)
+        self._phrase_batch = phrase.PhraseBatch(app)
+
+        # Tiles are picked by casting rays from the camera, unless the GPU
+        # picking buffer is enabled.
+        self._picking_texture = None
+        self._picking_scale = None
+        if Level.PICKING_BUFFER:
+            self._picking_texture = glutils.PickingTexture(app.window_width,
+                                                           app.window_height)
+            self._picking_shader = glutils.ShaderInstance(
+                app, 'level.vs', 'picking.fs',
+                [['modelMatrix', GL.GL_FLOAT_MAT4, None],
+                 ['colourIn', GL.GL_FLOAT_VEC4, [0, 0, 0, 0]]])
         self.picking_draw()
 
         self._hud = hud.Hud(app, self)
@@ -259,7 +315,6 @@ class Level(object):
                                          tile_info['colour']['a'])
                     idx = self.tile_coords_to_array_index(coords)
                     self.tiles[idx.y, idx.x] = Tile(self._app,
-                                                    self.cam,
                                                     coords,
                                                     tile_info['height'],
                                                     colour)
@@ -288,7 +343,7 @@ class Level(object):
             pass
 
         tile = self.lookup_tile(vector.Vector(0, 0))
-        self.base = Base(self._app, self.cam, tile, vector.Vector(0, 0),
+        self.base = Base(self._app, tile, vector.Vector(0, 0),
                          Tile.HEIGHT)
 
         self.money = 500
@@ -326,27 +381,57 @@ class Level(object):
             json.dump(level, f)
 
     def picking_draw(self):
-        """Draw the tiles to the picking buffer."""
+        """Draw the tiles to the picking buffer, if it is enabled.
+
+        This must be called whenever the camera or the tiles change. The
+        tiles are drawn at the resolution the scene is drawn at."""
+        if self._picking_texture is None:
+            return
+
+        res = self._app.resolution
+        self._picking_scale = res.scale
+        self._app.camera_buffer.set_resolution(res.width, res.height,
+                                               res.scale)
+        self._app.camera_buffer.update(self.cam)
         with self._picking_texture.enable():
+            GL.glViewport(0, 0, res.width, res.height)
             with self._picking_shader.use(download_uniforms=False):
                 GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT)
-                self._picking_shader.set_uniform('transMatrix')
                 for tile_list in self.tiles:
                     for tile in tile_list:
                         if tile:
                             tile.picking_draw(self._picking_shader)
+            GL.glViewport(0, 0, self._app.window_width,
+                          self._app.window_height)
 
-    def draw(self):
-        """Draw the level."""
-        self._draw_vertex_arrays()
-        self.base.draw()
+    def _visible_instances(self, instances, radius):
+        """Find which of a list of instances are within the camera's view.
+
+        Returns an array of the visible instances' data, and a mask of which
+        instances are visible."""
+        data = numpy.array(instances, numpy.float32).reshape(-1, 7)
+        visible = self.cam.points_visible(data[:, 0:3], radius)
+        return data[visible], visible
 
-        for tower in self._towers:
-            tower.draw()
+    def draw(self):
+        """Submit the level to the app's render queue."""
+        queue = self._app.render_queue
+        self._app.camera_buffer.update(self.cam)
+        self.terrain.draw(queue)
+        self.base.draw(queue)
+
+        towers, _ = self._visible_instances(
+            [t.instance for t in self._towers], Level._TOWER_RADIUS)
+        self._tower_instances.draw(queue, towers)
+
+        enemies, _ = self._visible_instances(
+            [e.instance for e in self.enemies], Level._ENEMY_RADIUS)
+        self._enemy_instances.draw(queue, enemies)
         for e in self.enemies:
-            e.draw()
+            e.draw(self._phrase_batch)
+        self._phrase_batch.draw(queue, self.cam)
 
-        self._hud.draw()
+        self._hud.draw(queue)
 
     def play(self):
         """Move from build into play state."""
@@ -368,8 +453,8 @@ class Level(object):
                 self.enemies.remove(e)
 
             # Update towers
-            for tower in self._towers:
-                tower.update()
+            for t in self._towers:
+                t.update()
 
             # Spawn new enemies
             active_waves = False
@@ -385,8 +470,13 @@ class Level(object):
                 self.state = Level.State.build
                 # TODO: Check if we've finished the last phase.
 
+        # Enemies and towers move throughout the defend phase.
+        if self.state == Level.State.defend or self._hud.animating:
+            self.dirty = True
+
     def on_click(self, x, y, button):
         """Handle a mouse click."""
+        self.dirty = True
 
         if self.state == Level.State.build:
             hit_hud = self._hud.on_click(x, y)
@@ -398,17 +488,28 @@ class Level(object):
                     # base
                     if (self.tower_creator is not None and
                             self.money >= self.tower_creator.COST):
-                        tower = self.tower_creator(self._app, self, tile)
-                        self._towers.append(tower)
-                        tile.tower = tower
-                        self.money -= tower.COST
+                        new_tower = self.tower_creator(self._app, self, tile)
+                        self._towers.append(new_tower)
+                        tile.tower = new_tower
+                        self.money -= new_tower.COST
 
     def on_keydown(self, key):
         """Handle keydown events."""
-        pass
+        if key in Level._PAN_DIRECTIONS:
+            dx, dy = Level._PAN_DIRECTIONS[key]
+            self.cam.pan(dx * Level._PAN_STEP, dy * Level._PAN_STEP)
+            self.picking_draw()
+            self.dirty = True
+
+    def on_scroll(self, amount):
+        """Handle mouse wheel events, zooming the camera."""
+        self.cam.zoom(Level._ZOOM_STEP ** amount)
+        self.picking_draw()
+        self.dirty = True
 
     def on_text(self, c):
         """Handle text input."""
+        self.dirty = True
         self._update_target(c)
         if self._target and self._target():
             target = self._target()
@@ -432,14 +533,22 @@ class Level(object):
 
     def lookup_tile(self, coords):
         """Look up a tile from its (q, r) coordinates."""
-        if not self.tile_coords_valid:
+        if not self.tile_coords_valid(coords):
             return None
         index = self.tile_coords_to_array_index(coords)
         return self.tiles[index.y, index.x]
 
     def screen_coords_to_tile(self, coords):
         """Work out which tile a given point in screen coordinates is in."""
-        pixel_info = self._picking_texture.read(coords.x, coords.y)
+        if self._picking_texture is None:
+            return self._cast_ray(*self.cam.ray(coords))
+
+        if self._picking_scale != self._app.resolution.scale:
+            # The resolution has changed since the buffer was drawn.
+            self.picking_draw()
+        scale = self._picking_scale
+        pixel_info = self._picking_texture.read(int(coords.x * scale),
+                                                int(coords.y * scale))
 
         # The blue value will be 0 if no tile was hit
         if pixel_info[2] == 0:
@@ -448,6 +557,46 @@ class Level(object):
         # The q and r coordinates are stored in the r and g values, respectively
         return self.lookup_tile(vector.Vector(pixel_info[0], pixel_info[1]))
 
+    def _cast_ray(self, start, direction):
+        """Find the first tile hit by a ray.
+
+        The ray is followed across the hex grid from where it drops below
+        the top of the highest tile, one cell at a time, until it hits a
+        tile's column or goes below the ground."""
+        ox, oy, oz = (float(v) for v in start)
+        dx, dy, dz = (float(v) for v in direction)
+        if dz >= 0:
+            # Looking up, or along the ground.
+            return None
+
+        t = max(0.0, (self.terrain.top - oz) / dz)
+        coords = Tile.world_to_tile_coords(
+            vector.Vector(ox + dx * t, oy + dy * t))
+        q, r = (int(coords.q), int(coords.r))
+        apothem = Tile.SIZE * math.sqrt(3) / 2
+        while True:
+            # Find where the ray leaves the cell, and the cell it enters.
+            cx = Tile.SIZE * math.sqrt(3) * (q + r / 2)
+            cy = Tile.SIZE * (3 / 2) * r
+            t_exit = math.inf
+            step = (0, 0)
+            for (nx, ny), d in _HEX_EDGES:
+                speed = nx * dx + ny * dy
+                if speed > 0:
+                    t_edge = (apothem - nx * (ox - cx) -
+                              ny * (oy - cy)) / speed
+                    if t_edge < t_exit:
+                        t_exit, step = (t_edge, d)
+
+            # The ray descends, so it is lowest where it leaves the cell.
+            z_exit = oz + dz * t_exit
+            tile = self.lookup_tile(vector.Vector(q, r))
+            if tile is not None and z_exit <= tile.height * Tile.DEPTH:
+                return tile
+            if z_exit <= 0:
+                return None
+            q, r = (q + step[0], r + step[1])
+
     def screen_coords_to_tile_coords(self, coords):
         """Convert screen coordinates to tile coordinates.
 
@@ -506,78 +655,6 @@ class Level(object):
                 visited.add(nxt)
                 nxt.path_next = tile
 
-    def _build_vertex_arrays(self):
-        # TODO: Could make data smaller with indirect buffers
-        all_verts = []
-        for tile in self.iter_tiles():
-            for s in range(tile.height):
-                face_top_verts, face_vert_verts = ([], [])
-                line_top_verts, line_vert_verts = ([], [])
-                for i in range(6):
-                    angle = 2 * math.pi / 6
-                    z = 0 + Tile.DEPTH * s
-                    px = tile.x + Tile.SIZE * math.sin(angle * (5 - i))
-                    py = tile.y + Tile.SIZE * math.cos(angle * (5 - i))
-                    face_top_verts.extend([px, py, z + Tile.DEPTH,
-                                           tile.face_colour.r,
-                                           tile.face_colour.g,
-                                           tile.face_colour.b,
-                                           tile.face_colour.a])
-                    line_top_verts.extend([px, py, z + Tile.DEPTH,
-                                           tile.outline_colour.r,
-                                           tile.outline_colour.g,
-                                           tile.outline_colour.b,
-                                           tile.outline_colour.a])
-
-                    px = tile.x + Tile.SIZE * math.sin(angle * i)
-                    py = tile.y + Tile.SIZE * math.cos(angle * i)
-                    face_vert_verts.extend([px, py, z,
-                                            tile.face_colour.r,
-                                            tile.face_colour.g,
-                                            tile.face_colour.b,
-                                            tile.face_colour.a,
-                                            px, py, z + Tile.DEPTH,
-                                            tile.face_colour.r,
-                                            tile.face_colour.g,
-                                            tile.face_colour.b,
-                                            tile.face_colour.a])
-                    line_vert_verts.extend([px, py, z,
-                                            tile.face_colour.r,
-                                            tile.face_colour.g,
-                                            tile.face_colour.b,
-                                            tile.face_colour.a,
-                                            px, py, z + Tile.DEPTH,
-                                            tile.face_colour.r,
-                                            tile.face_colour.g,
-                                            tile.face_colour.b,
-                                            tile.face_colour.a])
-                all_verts.extend(face_top_verts + face_vert_verts +
-                                 line_top_verts + line_vert_verts)
-
-        verts = numpy.array(all_verts, numpy.float32)
-        self._vao = glutils.VertexArray()
-        self._vbo = glutils.VertexBuffer()
-        with self._vao.bind():
-            self._vbo.bind()
-            GL.glBufferData(GL.GL_ARRAY_BUFFER, verts.nbytes, verts,
-                            GL.GL_STATIC_DRAW)
-            GL.glEnableVertexAttribArray(0)
-            GL.glVertexAttribPointer(0, 3, GL.GL_FLOAT, GL.GL_FALSE, 7 * 4,
-                                     None)
-            GL.glEnableVertexAttribArray(1)
-            GL.glVertexAttribPointer(1, 4, GL.GL_FLOAT, GL.GL_FALSE, 7 * 4,
-                                     ctypes.c_void_p(12))
-
-    def _draw_vertex_arrays(self):
-        with self._vao.bind(), self._shader.use():
-            tile_count = len([t for t in self.iter_tiles()])
-            for i in range(tile_count):
-                GL.glDrawArrays(GL.GL_TRIANGLE_FAN, i * 36, 6)
-                GL.glDrawArrays(GL.GL_TRIANGLE_STRIP, 6 + i * 36, 12)
-                with glutils.linewidth(2):
-                    GL.glDrawArrays(GL.GL_LINE_LOOP, 18 + i * 36, 6)
-                    GL.glDrawArrays(GL.GL_LINES, 24 + i * 36, 12)
-
     def _update_target(self, c):
         """Check whether we have a target, and find a new one if not."""
         if not self._target or not self._target():
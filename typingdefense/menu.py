@@ -1,6 +1,7 @@
 import ctypes
 import numpy
 import OpenGL.GL as GL
+import typingdefense.glutils as glutils
 
 
 class MenuItem(object):
@@ -36,42 +37,37 @@ class MenuScreen(object):
             self._bg_tex = app.resources.load_texture(self._background)
             self._bg_texunit_uniform = self._bg_shader.uniform('texUnit')
 
-            # Set up geometry
-            self._bg_vao = GL.glGenVertexArrays(1)
-            GL.glBindVertexArray(self._bg_vao)
-            self._bg_vbo = GL.glGenBuffers(1)
-            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self._bg_vbo)
+            # Set up geometry, mapping the texture coordinates to wherever
+            # the image is in its texture.
             verts = numpy.array(
                 # X   Y  U  V
                 [-1, -1, 0, 0,
                  -1,  1, 0, 1,
                   1, -1, 1, 0,
                   1,  1, 1, 1],
-                dtype=numpy.float32)
-            GL.glBufferData(GL.GL_ARRAY_BUFFER, verts.nbytes, verts,
-                            GL.GL_STATIC_DRAW)
-            GL.glEnableVertexAttribArray(0)
-            GL.glEnableVertexAttribArray(1)
-            GL.glVertexAttribPointer(0, 2, GL.GL_FLOAT, GL.GL_FALSE, 16, None)
-            GL.glVertexAttribPointer(1, 2, GL.GL_FLOAT, GL.GL_FALSE, 16,
-                                     ctypes.c_void_p(8))
-            GL.glBindVertexArray(0)
-
-    def __del__(self):
-        # TODO: release VAO etc?
-        pass
+                dtype=numpy.float32).reshape(4, 4)
+            u, v, w, h = self._bg_tex.texcoords_rect(
+                0, 0, self._bg_tex.width, self._bg_tex.height)
+            verts[:, 2:4] = verts[:, 2:4] * (w, h) + (u, v)
+            self._bg_vao = glutils.VertexArray()
+            self._bg_vbo = glutils.VertexBuffer()
+            with self._bg_vao.bind():
+                self._bg_vbo.bind()
+                glutils.buffer_data(GL.GL_ARRAY_BUFFER, verts.nbytes, verts,
+                                    GL.GL_STATIC_DRAW)
+                GL.glEnableVertexAttribArray(0)
+                GL.glEnableVertexAttribArray(1)
+                GL.glVertexAttribPointer(0, 2, GL.GL_FLOAT, GL.GL_FALSE, 16,
+                                         None)
+                GL.glVertexAttribPointer(1, 2, GL.GL_FLOAT, GL.GL_FALSE, 16,
+                                         ctypes.c_void_p(8))
 
     def draw(self):
         if self._background:
             self._bg_shader.use()
-            self._bg_tex.bind()
-            GL.glUniform1i(self._bg_texunit_uniform, 0)
-
-            GL.glBindVertexArray(self._bg_vao)
-            GL.glDrawArrays(GL.GL_TRIANGLE_STRIP, 0, 4)
-
-            GL.glBindVertexArray(0)
-            GL.glUseProgram(0)
+            glutils.state.uniform(self._bg_texunit_uniform, GL.GL_INT, 0)
+            with self._bg_tex.bind(), self._bg_vao.bind():
+                GL.glDrawArrays(GL.GL_TRIANGLE_STRIP, 0, 4)
 
 
 class Menu(object):
@@ -0,0 +1,219 @@
+"""Functions for building hex meshes with NumPy."""
+import math
+import numpy
+
+
+# The corners of a hex of unit size, centred on the origin, in clockwise order
+# starting from the top.
+HEX_CORNERS = numpy.array([[math.sin((2 * math.pi / 6) * i),
+                            math.cos((2 * math.pi / 6) * i)]
+                           for i in range(6)], numpy.float32)
+
+# Indices of the corners of a ring which make up the top face of a hex as a
+# triangle list, counter-clockwise so that it faces up.
+_TOP_FACE = numpy.array([[0, i, i - 1] for i in range(5, 1, -1)],
+                        numpy.uint32).reshape(-1)
+
+# Indices of the triangles making up the sides of a stack, relative to the
+# bottom ring of the stack. The top ring follows the bottom ring.
+_SIDES = numpy.array([[i, 6 + i, (i + 1) % 6,
+                       6 + i, 6 + (i + 1) % 6, (i + 1) % 6]
+                      for i in range(6)], numpy.uint32).reshape(-1)
+
+# Indices of the two triangles making up a side quad, whose vertices are in
+# the order bottom left, top left, bottom right, top right (from outside).
+_SIDE_QUAD = numpy.array([0, 1, 2, 1, 3, 2], numpy.uint32)
+
+# Indices of the lines outlining the top face of a hex.
+_TOP_OUTLINE = numpy.array([[i, (i + 1) % 6] for i in range(6)],
+                           numpy.uint32).reshape(-1)
+
+# Axial (q, r) directions to the neighbour across each side of a hex. Side i
+# runs between corners i and i + 1. These are also used by the terrain and
+# for picking, so that they agree on the neighbours of a tile.
+SIDE_DIRECTIONS = [(0, 1), (1, 0), (1, -1), (0, -1), (-1, 0), (-1, 1)]
+
+
+def _ranges(counts):
+    """Concatenate range(count) for each element of counts."""
+    starts = numpy.cumsum(counts) - counts
+    return numpy.arange(counts.sum()) - numpy.repeat(starts, counts)
+
+
+def hex_stacks(centre, size, depth, stacks):
+    """Build the vertices of a column of hex stacks.
+
+    For each stack, the six vertices of the top face (as a triangle fan) are
+    followed by twelve vertices making up the sides (as a triangle strip), or
+    equivalently the top outline (as a line loop) and the vertical edges (as
+    lines). Returns an array of shape (stacks * 18, 3)."""
+    verts = numpy.empty((stacks, 18, 3), numpy.float32)
+    bottoms = centre[2] + depth * numpy.arange(stacks, dtype=numpy.float32)
+
+    top = HEX_CORNERS[::-1] * size
+    verts[:, 0:6, 0:2] = top + centre[0:2]
+    verts[:, 0:6, 2] = (bottoms + depth)[:, numpy.newaxis]
+
+    sides = numpy.repeat(HEX_CORNERS * size, 2, axis=0)
+    verts[:, 6:18, 0:2] = sides + centre[0:2]
+    verts[:, 6:18:2, 2] = bottoms[:, numpy.newaxis]
+    verts[:, 7:18:2, 2] = (bottoms + depth)[:, numpy.newaxis]
+    return verts.reshape(-1, 3)
+
+
+def hex_column_triangles(size, height):
+    """Build the faces of a hex column standing on the origin.
+
+    Returns an array of vertex positions for a triangle list containing the
+    top face and the six sides of the column."""
+    rings = numpy.empty((12, 3), numpy.float32)
+    rings[:, 0:2] = numpy.tile(HEX_CORNERS * size, (2, 1))
+    rings[0:6, 2] = 0
+    rings[6:12, 2] = height
+    return rings[numpy.concatenate([_TOP_FACE + 6, _SIDES])]
+
+
+def hex_centres(coords, size):
+    """Convert an (n, 2) array of axial (q, r) coordinates to world (x, y)."""
+    centres = numpy.empty((len(coords), 2), numpy.float32)
+    centres[:, 0] = size * math.sqrt(3) * (coords[:, 0] + coords[:, 1] / 2)
+    centres[:, 1] = size * (3 / 2) * coords[:, 1]
+    return centres
+
+
+def neighbour_heights(coords, heights):
+    """Find the heights of the neighbours on each side of a set of tiles.
+
+    coords is an (n, 2) integer array of axial (q, r) tile coordinates. The
+    result is an (n, 6) array holding the height of the neighbour across each
+    side, in the same order as the sides built by terrain. Sides with no
+    neighbour have height 0."""
+    if len(coords) == 0:
+        return numpy.zeros((0, 6), numpy.int64)
+
+    # Scatter the heights into a grid with a border, so that every neighbour
+    # lookup is in range.
+    offsets = coords - coords.min(axis=0) + 1
+    grid = numpy.zeros(offsets.max(axis=0) + 2, numpy.int64)
+    grid[offsets[:, 0], offsets[:, 1]] = heights
+    return grid_neighbour_heights(grid, offsets)
+
+
+def grid_neighbour_heights(grid, offsets):
+    """Find the heights of the neighbours of tiles in a grid of heights.
+
+    grid is indexed by [q, r], and offsets is an (n, 2) array of the grid
+    positions of the tiles, none of which may be on the edge of the grid."""
+    result = numpy.empty((len(offsets), 6), numpy.int64)
+    for side, (dq, dr) in enumerate(SIDE_DIRECTIONS):
+        result[:, side] = grid[offsets[:, 0] + dq, offsets[:, 1] + dr]
+    return result
+
+
+def terrain(coords, heights, face_colours, outline_colours, size, depth,
+            neighbours=None):
+    """Build an indexed mesh for a set of hex tiles.
+
+    coords is an (n, 2) integer array of axial tile coordinates, heights holds
+    the number of stacks in each tile, and the colours are (n, c) arrays, such
+    as RGBA colours or indices into a palette. Each vertex holds a position
+    followed by a colour.
+    neighbours optionally holds the heights of the neighbours of each tile,
+    as returned by neighbour_heights, for tiles with neighbours which aren't
+    in the mesh.
+
+    Hidden geometry is left out: each tile has a single top face, and only
+    the parts of its sides which are above the neighbouring tile are built.
+    The outline is made up of the edges of the top face, a line at each
+    stack level across the exposed sides, and the vertical edges between
+    exposed sides.
+
+    Returns the vertices, as an array of shape (m, 3 + c), the face triangle
+    indices and the outline line indices."""
+    coords = numpy.asarray(coords, numpy.int64).reshape(-1, 2)
+    heights = numpy.asarray(heights, numpy.int64)
+    centres = hex_centres(coords, size)
+    corners = HEX_CORNERS * size
+    next_corners = numpy.roll(corners, -1, axis=0)
+    tops = (heights * depth).astype(numpy.float32)
+
+    # Work out which sides are exposed, and from what height.
+    if neighbours is None:
+        neighbours = neighbour_heights(coords, heights)
+    bottoms = numpy.asarray(neighbours, numpy.int64).reshape(-1, 6)
+    side_tiles, sides = numpy.nonzero(bottoms < heights[:, numpy.newaxis])
+    side_bottoms = bottoms[side_tiles, sides]
+
+    # Each corner's vertical edge starts at the lower of its two sides.
+    edge_bottoms = numpy.minimum(bottoms, numpy.roll(bottoms, 1, axis=1))
+    edge_tiles, edges = numpy.nonzero(
+        edge_bottoms < heights[:, numpy.newaxis])
+
+    # Each exposed side has a line at each stack level between the
+    # neighbour's top and its own.
+    level_counts = heights[side_tiles] - side_bottoms - 1
+    level_sides = numpy.repeat(numpy.arange(len(sides)), level_counts)
+    levels = side_bottoms[level_sides] + 1 + _ranges(level_counts)
+
+    tile_count = len(heights)
+    side_count = len(sides)
+    counts = [tile_count * 6, side_count * 4, tile_count * 6,
+              len(levels) * 2, len(edges) * 2]
+    starts = numpy.cumsum(counts) - counts
+    width = 3 + face_colours.shape[1]
+    verts = numpy.empty((sum(counts), width), numpy.float32)
+
+    # Face vertices: the top of each tile, then the corners of each exposed
+    # side, in the order bottom left, top left, bottom right, top right.
+    top_faces = verts[starts[0]:starts[1]].reshape(-1, 6, width)
+    top_faces[:, :, 0:2] = centres[:, numpy.newaxis, :] + corners
+    top_faces[:, :, 2] = tops[:, numpy.newaxis]
+    top_faces[:, :, 3:] = face_colours[:, numpy.newaxis, :]
+
+    side_faces = verts[starts[1]:starts[2]].reshape(-1, 4, width)
+    side_centres = centres[side_tiles]
+    side_faces[:, 0:2, 0:2] = (side_centres +
+                               corners[sides])[:, numpy.newaxis, :]
+    side_faces[:, 2:4, 0:2] = (side_centres +
+                               next_corners[sides])[:, numpy.newaxis, :]
+    side_faces[:, 0::2, 2] = (side_bottoms * depth)[:, numpy.newaxis]
+    side_faces[:, 1::2, 2] = tops[side_tiles, numpy.newaxis]
+    side_faces[:, :, 3:] = face_colours[side_tiles, numpy.newaxis, :]
+
+    # Outline vertices: the top of each tile, then pairs of vertices for the
+    # lines at each stack level, and for the vertical edges.
+    top_lines = verts[starts[2]:starts[3]].reshape(-1, 6, width)
+    top_lines[:, :, 0:3] = top_faces[:, :, 0:3]
+    top_lines[:, :, 3:] = outline_colours[:, numpy.newaxis, :]
+
+    level_lines = verts[starts[3]:starts[4]].reshape(-1, 2, width)
+    level_tiles = side_tiles[level_sides]
+    level_lines[:, 0, 0:2] = centres[level_tiles] + corners[
+        sides[level_sides]]
+    level_lines[:, 1, 0:2] = centres[level_tiles] + next_corners[
+        sides[level_sides]]
+    level_lines[:, :, 2] = (levels * depth)[:, numpy.newaxis]
+    level_lines[:, :, 3:] = outline_colours[level_tiles, numpy.newaxis, :]
+
+    edge_lines = verts[starts[4]:].reshape(-1, 2, width)
+    edge_lines[:, :, 0:2] = (centres[edge_tiles] +
+                             corners[edges])[:, numpy.newaxis, :]
+    edge_lines[:, 0, 2] = edge_bottoms[edge_tiles, edges] * depth
+    edge_lines[:, 1, 2] = tops[edge_tiles]
+    edge_lines[:, :, 3:] = outline_colours[edge_tiles, numpy.newaxis, :]
+
+    # Indices of the faces and outlines.
+    top_face_indices = (numpy.arange(tile_count, dtype=numpy.uint32)
+                        [:, numpy.newaxis] * 6 + _TOP_FACE)
+    side_face_indices = (numpy.arange(side_count, dtype=numpy.uint32)
+                         [:, numpy.newaxis] * 4 + _SIDE_QUAD + starts[1])
+    face_indices = numpy.concatenate([top_face_indices.reshape(-1),
+                                      side_face_indices.reshape(-1)])
+
+    top_line_indices = (numpy.arange(tile_count, dtype=numpy.uint32)
+                        [:, numpy.newaxis] * 6 + _TOP_OUTLINE + starts[2])
+    outline_indices = numpy.concatenate([
+        top_line_indices.reshape(-1),
+        numpy.arange(starts[3], len(verts), dtype=numpy.uint32)])
+
+    return verts, face_indices, outline_indices
@@ -1,55 +1,183 @@
 """Module for managing in-game phrases."""
+import ctypes
+import numpy
 from OpenGL import GL
-from typingdefense.text import Text
 import typingdefense.glutils as glutils
+import typingdefense.render as render
+import typingdefense.text as text
 
 
-class PhraseText(Text):
-    """Class for displaying text for a phrase.
+class PhraseBatch(object):
+    """Draws the text of all on-screen phrases with a single draw call.
 
-    This is text associated with a position in the (3D) game world, but
-    projected so that it appears the same size regardless of depth."""
-    def __init__(self, app, cam, font, text, x, y, height,
-                 align=Text.Align.left):
-        super().__init__(font, text, x, y, height, align)
+    Phrase text is associated with a position in the (3D) game world, but
+    projected so that it appears the same size regardless of depth. Each
+    vertex carries the world origin of its phrase, and a flag saying whether
+    its character has been typed, so that every phrase can share one buffer.
+    """
+    HEIGHT = 48
 
+    # The initial capacity of the stream buffer, in characters per frame.
+    CAPACITY = 1024
+
+    # Vertex format: position relative to the phrase origin, in whole
+    # pixels, normalised texture coordinates, phrase origin and typed flag,
+    # taking 24 bytes.
+    _VERTEX = numpy.dtype([('position', numpy.int16, 2),
+                           ('texcoord', numpy.uint16, 2),
+                           ('origin', numpy.float32, 3),
+                           ('typed', numpy.uint8),
+                           ('pad', numpy.uint8, 3)])
+
+    # Indices of the two triangles making up each character's quad, whose
+    # vertices are in the order bottom left, bottom right, top left, top
+    # right.
+    _QUAD = numpy.array([0, 1, 2, 2, 1, 3], numpy.uint32)
+
+    def __init__(self, app):
+        self._font = app.resources.load_font('DejaVuSans.ttf',
+                                             PhraseBatch.HEIGHT)
         self._shader = glutils.ShaderInstance(
             app, 'phrase_text.vs', 'phrase_text.fs',
-            [('transMatrix', GL.GL_FLOAT_MAT4, cam.trans_matrix_as_array()),
-             ('origin', GL.GL_FLOAT_VEC3, None),
-             ('screenDimensions', GL.GL_FLOAT_VEC2,
-              [app.window_width, app.window_height]),
-             ('texUnit', GL.GL_INT, 0),
-             ('inColour', GL.GL_FLOAT_VEC3, [1, 1, 1])])
+            [('texUnit', GL.GL_INT, 0)])
+
+        self._phrases = []
+        self._max_chars = 0
+
+        self._vao = glutils.VertexArray()
+        self._vbo = glutils.StreamBuffer(
+            GL.GL_ARRAY_BUFFER, PhraseBatch.CAPACITY * 4 *
+            PhraseBatch._VERTEX.itemsize)
+        self._ibo = glutils.IndexBuffer()
+        with self._vao.bind():
+            self._vbo.bind()
+            self._ibo.bind()
+            for attribute in range(4):
+                GL.glEnableVertexAttribArray(attribute)
+            self._point_attributes(0)
+
+    def _point_attributes(self, offset):
+        """Point the vertex attributes at vertices starting at a byte offset
+        in the stream buffer, which must be bound along with the vertex
+        array."""
+        stride = PhraseBatch._VERTEX.itemsize
+        GL.glVertexAttribPointer(0, 2, GL.GL_SHORT, GL.GL_FALSE, stride,
+                                 ctypes.c_void_p(offset))
+        GL.glVertexAttribPointer(1, 2, GL.GL_UNSIGNED_SHORT, GL.GL_TRUE,
+                                 stride, ctypes.c_void_p(offset + 4))
+        GL.glVertexAttribPointer(2, 3, GL.GL_FLOAT, GL.GL_FALSE, stride,
+                                 ctypes.c_void_p(offset + 8))
+        GL.glVertexAttribPointer(3, 1, GL.GL_UNSIGNED_BYTE, GL.GL_TRUE,
+                                 stride, ctypes.c_void_p(offset + 20))
+
+    def add(self, phrase, origin):
+        """Add a phrase to be drawn at a world position this frame."""
+        if phrase.text:
+            self._phrases.append((phrase, origin))
+
+    def _layout(self):
+        """Lay out all the phrases added this frame."""
+        return [text.layout(self._font, phrase.text,
+                            PhraseBatch.HEIGHT, text.Align.center)[0]
+                for phrase, _ in self._phrases]
+
+    def _build(self, verts, layouts):
+        """Fill in the vertices of the phrases added this frame."""
+        start = 0
+        for (phrase, origin), quads in zip(self._phrases, layouts):
+            phrase_verts = verts[start:start + len(quads)]
+            phrase_verts['position'] = numpy.round(quads[:, 0:2])
+            phrase_verts['texcoord'] = numpy.round(quads[:, 2:4] * 65535)
+            phrase_verts['origin'] = (origin.x, origin.y, origin.z)
+            phrase_verts['typed'] = 0
+            phrase_verts['typed'][0:phrase.typed_chars * 4] = 255
+            start += len(quads)
+
+    def _grow_indices(self, chars):
+        """Make sure there are indices for enough characters.
+
+        The indices only depend on the number of characters, so are only
+        rebuilt when there are more characters than ever before. The vertex
+        array must be bound."""
+        if chars > self._max_chars:
+            self._max_chars = max(chars, self._max_chars * 2)
+            indices = (numpy.arange(self._max_chars, dtype=numpy.uint32)
+                       [:, numpy.newaxis] * 4 + PhraseBatch._QUAD)
+            glutils.buffer_data(GL.GL_ELEMENT_ARRAY_BUFFER, indices.nbytes,
+                                indices, GL.GL_STATIC_DRAW)
+
+    def _cull(self, cam):
+        """Drop the phrases whose text is entirely off the screen.
+
+        The text is tested in normalised device coordinates, offset from the
+        projected origin of each phrase in the same way as by the shader, so
+        phrases are kept while any of their text is visible."""
+        origins = numpy.array([(o.x, o.y, o.z, 1) for _, o in self._phrases],
+                              numpy.float32)
+        projected = numpy.asarray(origins * cam.trans_matrix.T)
+        in_front = projected[:, 3] > 0
+        projected[~in_front, 3] = 1
+        ndc = projected[:, 0:3] / projected[:, 3:4]
+
+        widths = numpy.array([text.layout(self._font, phrase.text,
+                                          PhraseBatch.HEIGHT,
+                                          text.Align.center)[1]
+                              for phrase, _ in self._phrases])
+        half_width = widths / 2 / cam.screen_width
+        height = PhraseBatch.HEIGHT / cam.screen_height
+
+        visible = (in_front & (numpy.abs(ndc[:, 2]) <= 1) &
+                   (ndc[:, 0] - half_width <= 1) &
+                   (ndc[:, 0] + half_width >= -1) &
+                   (ndc[:, 1] <= 1) & (ndc[:, 1] + height >= -1))
+        self._phrases = [p for p, show in zip(self._phrases, visible) if show]
+
+    def draw(self, queue, cam):
+        """Submit the phrases added this frame which are visible from a
+        camera to a render queue."""
+        if self._phrases:
+            self._cull(cam)
+        if self._phrases:
+            queue.submit(render.RenderQueue.OVERLAY, self._shader.program,
+                         self._vao.id, self._draw,
+                         texture=self._font.texture.id)
 
-    def draw(self, x, y, z, typedchars):
-        """Draw the text."""
-        self._shader.set_uniform('origin', [x, y, z], download=False)
+    def _draw(self, _):
+        """Draw the phrases added this frame, then clear the batch."""
+        generation = None
+        while generation != self._font.generation:
+            # Glyphs may move in the font's texture while laying out the
+            # phrases, leaving earlier layouts out of date.
+            generation = self._font.generation
+            layouts = self._layout()
+        count = sum(len(quads) for quads in layouts)
 
         GL.glDisable(GL.GL_DEPTH_TEST)
-        with self._shader.use(), self._vao.bind(), self._font.bind():
-            self._shader.set_uniform('inColour', [1, 0, 0])
-            for i in range(len(self._text)):
-                if i == typedchars:
-                    self._shader.set_uniform('inColour', [1, 1, 1])
-                GL.glDrawArrays(GL.GL_TRIANGLE_STRIP, i * 4, 4)
+        with self._vao.bind():
+            # The vertices are written straight into the stream buffer.
+            with self._vbo.map(PhraseBatch._VERTEX, count) as (verts, offset):
+                self._build(verts, layouts)
+            self._point_attributes(offset)
+            self._grow_indices(count // 4)
+            with self._shader.use(), self._font.bind():
+                GL.glDrawElements(GL.GL_TRIANGLES, count // 4 * 6,
+                                  GL.GL_UNSIGNED_INT, None)
         GL.glEnable(GL.GL_DEPTH_TEST)
+        self._phrases = []
 
 
 class Phrase(object):
     """Class representing an in-game phrase."""
 
-    def __init__(self, app, cam, phrase):
-        font = app.resources.load_font('menufont.fnt')
-        self._text = PhraseText(app, cam, font, phrase, 0, 0, 48,
-                                Text.Align.center)
-        self._typed_chars = 0
+    def __init__(self, phrase):
+        self.text = phrase
+        self.typed_chars = 0
         self._hit = False
 
     @property
     def complete(self):
         """Whether the phrase has been completed."""
-        return len(self._text.text) == self._typed_chars
+        return len(self.text) == self.typed_chars
 
     @property
     def hit(self):
@@ -59,17 +187,17 @@ class Phrase(object):
     @property
     def start(self):
         """Returns the first character of the phrase."""
-        return self._text.text[0]
+        return self.text[0]
 
     def on_type(self, c):
         """Update the phrase on typing text targetted at it."""
-        if self._typed_chars < len(self._text.text):
-            if c == self._text.text[self._typed_chars]:
-                self._typed_chars += 1
+        if self.typed_chars < len(self.text):
+            if c == self.text[self.typed_chars]:
+                self.typed_chars += 1
                 self._hit = True
             else:
                 self._hit = False
 
-    def draw(self, origin):
-        """Draw the phrase."""
-        self._text.draw(origin.x, origin.y, origin.z, self._typed_chars)
+    def draw(self, batch, origin):
+        """Add the phrase to the batch of phrases drawn this frame."""
+        batch.add(self, origin)
@@ -1,69 +1,163 @@
+import bisect
+import collections
+import concurrent.futures
 import random
+import threading
 
 
-class ConcatList(object):
-    """A class for concatenating lists without copying the lists.
+# The finger used to type each key on a QWERTY keyboard, numbered from the
+# left little finger (0) to the right little finger (7).
+_FINGERS = {c: finger
+            for finger, keys in enumerate(['qaz', 'wsx', 'edc', 'rfvtgb',
+                                           'yhnujm', 'ik', 'ol', 'p'])
+            for c in keys}
 
-    This works using a list of references to the lists in the concatenation.
-    Modifying the constituent lists will modify the ConcatList accordingly."""
-    def __init__(self, *args):
-        self._lists = []
-        for a in args:
-            self._lists.append(a)
+# Weights of the components of the typing difficulty score.
+_LENGTH_WEIGHT = 1.0
+_SAME_FINGER_WEIGHT = 1.5
+_SAME_HAND_WEIGHT = 0.5
+_RARE_LETTER_WEIGHT = 2.0
 
-    def _add(self, l):
-        if type(l) is not list:
-            raise TypeError('Can only add lists to ConcatList')
-        if l not in self._lists:
-            self._lists.append(l)
+# The maximum number of words in a multi-word phrase.
+_MAX_PHRASE_WORDS = 6
+
+
+def _typing_difficulty(word, rarity):
+    """Calculate the raw typing difficulty of a word.
+
+    The score increases with the length of the word, with bigrams typed by
+    the same finger, with consecutive keys typed by the same hand, and with
+    the rarity of the letters in the word. rarity is a dictionary mapping
+    letters to a value from 0 (most common) to 1 (rarest).
+    """
+    score = len(word) * _LENGTH_WEIGHT
+    for c in word:
+        score += rarity.get(c, 1) * _RARE_LETTER_WEIGHT
+
+    for a, b in zip(word, word[1:]):
+        if a not in _FINGERS or b not in _FINGERS:
+            continue
+        if a != b and _FINGERS[a] == _FINGERS[b]:
+            score += _SAME_FINGER_WEIGHT
+        if (_FINGERS[a] < 4) == (_FINGERS[b] < 4):
+            score += _SAME_HAND_WEIGHT
+
+    return score
+
+
+def _in_band(score, difficulty):
+    """Whether a difficulty score is within a band.
+
+    Bands are half-open, except that the band reaching 1 includes it."""
+    if difficulty[1] >= 1:
+        return score >= difficulty[0]
+    return difficulty[0] <= score < difficulty[1]
+
+
+def _composition_tables(words):
+    """Build the tables used to compose phrases from a list of words.
+
+    Returns the words grouped by length, the words grouped by start letter
+    and length, and the ways and cumulative tables. ways[n][t] is the number
+    of distinct sequences of n words with t letters in total, and
+    cumulative[n][t] holds the running totals of those sequences by the
+    length of their first word. This lets the length of each word in a
+    phrase be sampled directly, with a bisect, rather than by trial and
+    error."""
+    words_by_length = collections.defaultdict(list)
+    words_by_start = collections.defaultdict(dict)
+    for word in words:
+        words_by_length[len(word)].append(word)
+        words_by_start[word[0]].setdefault(len(word), []).append(word)
+
+    max_length = max(words_by_length, default=0)
+    histogram = [len(words_by_length.get(l, ()))
+                 for l in range(max_length + 1)]
+
+    ways = [[1]]
+    cumulative = [[[]]]
+    for n in range(1, _MAX_PHRASE_WORDS + 1):
+        n_ways = []
+        n_cumulative = []
+        for t in range(n * max_length + 1):
+            running = 0
+            totals = []
+            for l in range(1, max_length + 1):
+                if 0 <= t - l < len(ways[n - 1]):
+                    running += histogram[l] * ways[n - 1][t - l]
+                totals.append(running)
+            n_ways.append(running)
+            n_cumulative.append(totals)
+        ways.append(n_ways)
+        cumulative.append(n_cumulative)
+
+    return words_by_length, words_by_start, ways, cumulative
+
+
+class _WordBucket(object):
+    """The words of a given length range and start letter.
+
+    Once compiled, the words are sorted by difficulty, and the scores list
+    holds the corresponding difficulty of each word."""
+    def __init__(self):
+        self.words = []
+        self.scores = []
 
     def __len__(self):
-        length = 0
-        for l in self._lists:
-            length += len(l)
-        return (length)
+        return len(self.words)
 
-    def __iter__(self):
-        for l in self._lists:
-            for i in l:
-                yield i
+    def band(self, difficulty):
+        """Find the slice of words within a difficulty band.
 
-    def __getitem__(self, index):
-        for l in self._lists:
-            if index < len(l):
-                return l[index]
-            else:
-                index -= len(l)
-        raise IndexError('ConcatList index out of range')
+        difficulty is a (min, max) tuple, or None for any difficulty. Bands
+        are half-open, including min but not max, except that a max of 1
+        includes the hardest words. Returns the start and end indices of the
+        matching words."""
+        if difficulty is None:
+            return (0, len(self.words))
+        if difficulty[1] >= 1:
+            end = len(self.words)
+        else:
+            end = bisect.bisect_left(self.scores, difficulty[1])
+        return (bisect.bisect_left(self.scores, difficulty[0]), end)
 
-    def __iadd__(self, other):
-        self._add(other)
-        return self
 
+class PhraseDictionary(object):
+    """The words loaded from a phrase file, indexed for phrase selection.
 
-class PhraseBook(object):
-    SINGLE_PHRASE = range(1, 2)
-    SHORT_PHRASE = range(2, 5)
-    MED_PHRASE = range(5, 8)
-    LONG_PHRASE = range(8, 12)
-    HUGE_PHRASE = range(12, 20)
-    def __init__(self, filename):
-        self._available_letters = set()
+    A dictionary is immutable once loaded, so it can be shared between levels.
+    The start letters currently in use are passed in to each query; levels
+    keep track of them using a PhraseBook.
 
+    If stop, a threading.Event, is set while loading, loading is abandoned
+    by raising concurrent.futures.CancelledError."""
+    def __init__(self, filename, stop=None):
+        self._stop = stop
         # Words are stored in the _phrases member according to their length and
         # start character.
         # This is a dictionary, keyed on a range representing the length of
         # words in the corresponding item. Each item is a dictionary keyed on
-        # the start character of words, where the corresponding item is a list
-        # containing all the words of the given length and start character.
+        # the start character of words, where the corresponding item is a
+        # _WordBucket containing all the words of the given length and start
+        # character, sorted by difficulty.
         self._phrases = {PhraseBook.SINGLE_PHRASE: {},
                          PhraseBook.SHORT_PHRASE: {},
                          PhraseBook.MED_PHRASE: {},
                          PhraseBook.LONG_PHRASE: {},
                          PhraseBook.HUGE_PHRASE: {}}
-        with open(filename, mode='r', encoding='ascii', errors='ignore') as f:
-            for line in [l.strip() for l in f]:
-                self._add_word(line)
+        with open(filename, mode='r', encoding='latin-1') as f:
+            for line in f:
+                self._check_stopped()
+                self._add_word(line.strip())
+        self._compile()
+        self._compile_compositions()
+
+        self.letters = frozenset(c for slot in self._phrases.values()
+                                 for c in slot)
+
+    def _check_stopped(self):
+        if self._stop is not None and self._stop.is_set():
+            raise concurrent.futures.CancelledError()
 
     def _add_word(self, word):
         if len(word) in PhraseBook.SINGLE_PHRASE:
@@ -82,24 +176,249 @@ class PhraseBook(object):
 
         start = word[0]
         if start not in slot:
-            slot[start] = []
-        slot[start].append(word)
-        self._available_letters.add(start)
-
-    def get_word(self, length):
-        words = ConcatList()
-        for c in self._available_letters:
-            if c in self._phrases[length]:
-                words += self._phrases[length][c]
-
-        word = random.choice(words)
-        self._available_letters.remove(word[0])
+            slot[start] = _WordBucket()
+        slot[start].words.append(word)
+
+    def _compile(self):
+        """Score all words by difficulty, and sort the buckets by score.
+
+        Raw scores are converted to their rank within the length range, scaled
+        to the range 0 to 1, so that difficulty bands select a similar
+        proportion of words whatever the length."""
+        letter_counts = collections.Counter()
+        for slot in self._phrases.values():
+            for bucket in slot.values():
+                for word in bucket.words:
+                    letter_counts.update(word)
+        most_common = max(letter_counts.values(), default=1)
+        rarity = {c: 1 - count / most_common
+                  for c, count in letter_counts.items()}
+
+        for slot in self._phrases.values():
+            scored = []
+            for bucket in slot.values():
+                self._check_stopped()
+                scored.extend((_typing_difficulty(word, rarity), word)
+                              for word in bucket.words)
+            scored.sort()
+            ranks = {}
+            for rank, (_, word) in enumerate(scored):
+                ranks[word] = rank / max(len(scored) - 1, 1)
+
+            for bucket in slot.values():
+                bucket.words.sort(key=ranks.__getitem__)
+                bucket.scores = [ranks[word] for word in bucket.words]
+
+    def _compile_compositions(self):
+        """Build the tables for composing multi-word phrases.
+
+        There are tables for each length range of PhraseBook and for words
+        of any length, each with every difficulty band and with no band, so
+        that composing a phrase only needs lookups and bisects."""
+        bands = (PhraseBook.EASY, PhraseBook.MEDIUM, PhraseBook.HARD)
+        groups = collections.defaultdict(list)
+        for word_length, slot in self._phrases.items():
+            for bucket in slot.values():
+                self._check_stopped()
+                for word, score in zip(bucket.words, bucket.scores):
+                    keys = [(word_length, None), (None, None)]
+                    for band in bands:
+                        if _in_band(score, band):
+                            keys += [(word_length, band), (None, band)]
+                    for key in keys:
+                        groups[key].append(word)
+
+        self._compositions = {}
+        for word_length in [None] + list(self._phrases):
+            for difficulty in (None,) + bands:
+                self._check_stopped()
+                self._compositions[(word_length, difficulty)] = (
+                    _composition_tables(groups[(word_length, difficulty)]))
+
+    def pick_word(self, length, difficulty, available):
+        """Pick a word starting with one of the available letters.
+
+        difficulty is an optional (min, max) band, such as PhraseBook.EASY.
+        If there are no words within the band, any difficulty is allowed."""
+        slot = self._phrases[length]
+        buckets = [slot[c] for c in available if c in slot]
+
+        candidates = []
+        total = 0
+        for bucket in buckets:
+            start, end = bucket.band(difficulty)
+            if end > start:
+                candidates.append((bucket, start, end))
+                total += end - start
+
+        if total == 0 and difficulty is not None:
+            return self.pick_word(length, None, available)
+        if total == 0:
+            raise IndexError('No words available')
+
+        index = random.randrange(total)
+        for bucket, start, end in candidates:
+            if index < end - start:
+                return bucket.words[start + index]
+            index -= end - start
+
+    def compose(self, length, count, available, word_length=None,
+                difficulty=None):
+        """Compose a phrase of several words.
+
+        length is a range of the total number of letters in the phrase
+        (excluding spaces), and count is the number of words. The phrase
+        starts with one of the available letters. If given, word_length is a
+        range of the length of each word, which must be one of the length
+        ranges of PhraseBook, and difficulty a band of PhraseBook which each
+        word's difficulty must be in. If no phrases can be made from words in
+        the band, any difficulty is allowed."""
+        if count > _MAX_PHRASE_WORDS:
+            raise ValueError('Phrases can have at most {} words'.format(
+                _MAX_PHRASE_WORDS))
+        if (word_length, difficulty) not in self._compositions:
+            raise ValueError('No phrases of words with lengths {} and '
+                             'difficulty {}'.format(word_length, difficulty))
+
+        words_by_length, words_by_start, ways, cumulative = (
+            self._compositions[(word_length, difficulty)])
+        max_length = max(words_by_length, default=0)
+
+        # Pick the total length and first word length together, weighted by
+        # the number of phrases that start with an available letter.
+        first_counts = [0] * (max_length + 1)
+        for c in available:
+            for l, words in words_by_start.get(c, {}).items():
+                first_counts[l] += len(words)
+
+        choices = []
+        totals = []
+        running = 0
+        rest = ways[count - 1]
+        for t in length:
+            for l in range(1, max_length + 1):
+                if 0 <= t - l < len(rest) and first_counts[l]:
+                    running += first_counts[l] * rest[t - l]
+                    choices.append((t, l))
+                    totals.append(running)
+        if running == 0 and difficulty is not None:
+            return self.compose(length, count, available, word_length)
+        if running == 0:
+            raise IndexError('No phrases available')
+        total, first_length = choices[
+            bisect.bisect_right(totals, random.randrange(running))]
+
+        index = random.randrange(first_counts[first_length])
+        for c in available:
+            candidates = words_by_start.get(c, {}).get(first_length, [])
+            if index < len(candidates):
+                words = [candidates[index]]
+                break
+            index -= len(candidates)
+
+        # Pick the remaining word lengths from the cumulative tables.
+        remaining = total - first_length
+        for n in range(count - 1, 0, -1):
+            totals = cumulative[n][remaining]
+            l = bisect.bisect_right(totals, random.randrange(totals[-1])) + 1
+            words.append(random.choice(words_by_length[l]))
+            remaining -= l
+
+        return ' '.join(words)
+
+
+class PhraseBook(object):
+    """The phrases used by a level.
+
+    The words themselves come from a shared PhraseDictionary. The phrasebook
+    tracks which start letters are in use in the level, so that each enemy's
+    phrase can be targeted by its first letter."""
+    SINGLE_PHRASE = range(1, 2)
+    SHORT_PHRASE = range(2, 5)
+    MED_PHRASE = range(5, 8)
+    LONG_PHRASE = range(8, 12)
+    HUGE_PHRASE = range(12, 20)
+
+    # Difficulty bands. Difficulties are normalised within each length range,
+    # so these select the easiest, middle and hardest thirds of the words.
+    # Each band includes its lower edge but not its upper one, so a word on
+    # the edge between two bands is only in the harder one.
+    EASY = (0, 1 / 3)
+    MEDIUM = (1 / 3, 2 / 3)
+    HARD = (2 / 3, 1)
+
+    def __init__(self, dictionary):
+        """Construct a phrasebook.
+
+        dictionary is a future for the PhraseDictionary, as returned by
+        Registry.load. It is only waited on when the first phrase is needed.
+        """
+        self._dictionary = dictionary
+        self._reserved_letters = set()
+
+    def _available_letters(self):
+        return self._dictionary.result().letters - self._reserved_letters
+
+    def get_word(self, length, difficulty=None):
+        """Pick a word with an available start letter."""
+        word = self._dictionary.result().pick_word(
+            length, difficulty, self._available_letters())
+        self._reserved_letters.add(word[0])
         return word
 
-    def get_phrase(self, length, count):
+    def compose(self, length, count, word_length=None, difficulty=None):
+        """Compose a phrase of count words with an available start letter.
+
+        length is a range of the total number of letters in the phrase, and
+        word_length and difficulty optionally limit the words used, as for
+        PhraseDictionary.compose."""
+        phrase = self._dictionary.result().compose(
+            length, count, self._available_letters(), word_length,
+            difficulty)
+        self._reserved_letters.add(phrase[0])
+        return phrase
+
+    def get_phrase(self, length, count, difficulty=None):
+        """Get a phrase of count words, each with a length in length, and
+        within the difficulty band if one is given."""
         if count > 1:
-            raise NotImplementedError('TODO: Multi-word phrases')
-        return self.get_word(length)
+            return self.compose(range(length.start * count,
+                                      (length.stop - 1) * count + 1),
+                                count, length, difficulty)
+        return self.get_word(length, difficulty)
 
     def release_start_letter(self, letter):
-        self._available_letters.add(letter)
+        self._reserved_letters.discard(letter)
+
+
+class Registry(object):
+    """A registry of phrase dictionaries shared by the whole game.
+
+    Dictionaries are loaded on a background thread, so that they can be
+    requested when the app starts and are ready by the time a level needs
+    them."""
+    # The dictionary used by the levels, relative to the working directory.
+    DEFAULT_DICTIONARY = 'resources/phrases/all.phr'
+
+    def __init__(self):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._stop = threading.Event()
+        self._dictionaries = {}
+
+    def load(self, filename):
+        """Start loading a dictionary, if not already loaded.
+
+        Returns a future for the PhraseDictionary."""
+        if filename not in self._dictionaries:
+            self._dictionaries[filename] = self._executor.submit(
+                PhraseDictionary, filename, self._stop)
+        return self._dictionaries[filename]
+
+    def shutdown(self):
+        """Stop loading dictionaries.
+
+        Loads not yet started are cancelled, and a load in progress stops at
+        its next check, so the loader thread, which isn't a daemon, doesn't
+        hold up the exit of the process."""
+        self._stop.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
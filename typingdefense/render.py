@@ -0,0 +1,161 @@
+"""Module for ordering and batching the draw calls of a frame."""
+import collections
+
+
+class RenderQueue(object):
+    """Collects the draw items of a frame, and draws them in a good order.
+
+    Each item has a sort key made up of its pass, program, texture, vertex
+    array and depth. Items are drawn in key order, so that items sharing
+    state are drawn together and the state changes between them are skipped
+    by the GL state tracker. Consecutive items with the same state and draw
+    function are merged into a single call of the function.
+
+    Depth comes last in the key, so it only orders items within a pass which
+    share the same program, texture and vertex array. Those are drawn front
+    to back, by increasing depth.
+
+    After each full flush, stats holds counts of the items, the draw function
+    calls and the state changes in the frame, along with the state changes
+    there would have been had the items been drawn in submission order.
+    These include any earlier partial flushes in the frame."""
+    OPAQUE = 0
+    OUTLINE = 1
+    OVERLAY = 2
+    HUD = 3
+
+    def __init__(self):
+        self._items = []
+        self._partial_stats = collections.Counter()
+        self.stats = collections.Counter()
+
+    def submit(self, render_pass, program, vao, draw, arg=None, texture=0,
+               depth=0):
+        """Submit a draw item.
+
+        program, vao and texture are the GL ids of the state used by the
+        item. draw is called with a list of the args of all the items merged
+        with this one, and should set up its own state."""
+        self._items.append(
+            ((render_pass, program, texture, vao, depth), draw, arg))
+
+    @staticmethod
+    def _state_changes(items):
+        """Count the state changes needed to draw items in order."""
+        changes = collections.Counter()
+        previous = None
+        for key, _, _ in items:
+            for name, index in (('program changes', 1),
+                                ('texture changes', 2),
+                                ('vertex array changes', 3)):
+                if previous is None or key[index] != previous[index]:
+                    changes[name] += 1
+            previous = key
+        return changes
+
+    def flush(self, last_pass=None):
+        """Draw the items submitted since the last flush.
+
+        If last_pass is given, only the items in that pass and the passes
+        before it are drawn, and the rest are kept for the next flush."""
+        items = self._items
+        self._items = []
+        if last_pass is not None:
+            self._items = [i for i in items if i[0][0] > last_pass]
+            items = [i for i in items if i[0][0] <= last_pass]
+
+        stats = collections.Counter(items=len(items))
+        for name, count in RenderQueue._state_changes(items).items():
+            stats['unsorted ' + name] = count
+
+        items.sort(key=lambda item: item[0])
+        stats.update(RenderQueue._state_changes(items))
+
+        start = 0
+        while start < len(items):
+            key, draw, _ = items[start]
+            end = start + 1
+            while (end < len(items) and items[end][0][0:4] == key[0:4] and
+                   items[end][1] == draw):
+                end += 1
+
+            draw([arg for _, _, arg in items[start:end]])
+            stats['draws'] += 1
+            start = end
+
+        if last_pass is None:
+            self.stats = self._partial_stats + stats
+            self._partial_stats = collections.Counter()
+        else:
+            self._partial_stats.update(stats)
+
+
+class ResolutionController(object):
+    """Chooses the scale of the resolution the scene is drawn at, to keep
+    the frame time under a target.
+
+    The frame time is smoothed, and the scale is lowered a step at a time
+    while it is over the target. The scale is raised again when the frame
+    time, scaled by the increase in the number of pixels, would still be
+    under the target. After each change, the controller waits for the frame
+    time to settle before changing the scale again."""
+    MIN_SCALE = 0.5
+    MAX_SCALE = 1.0
+    STEP = 0.1
+
+    # The weight of the previous smoothed frame time in each update.
+    _SMOOTHING = 0.9
+
+    # The number of frames to wait after changing the scale.
+    _SETTLE_FRAMES = 30
+
+    def __init__(self, window_width, window_height, target_frametime):
+        self._window_width = window_width
+        self._window_height = window_height
+        self.target_frametime = target_frametime
+        self.scale = ResolutionController.MAX_SCALE
+        self._frametime = None
+        self._settle = ResolutionController._SETTLE_FRAMES
+
+    @property
+    def width(self):
+        """The width of the scene, in pixels."""
+        return max(1, int(round(self._window_width * self.scale)))
+
+    @property
+    def height(self):
+        """The height of the scene, in pixels."""
+        return max(1, int(round(self._window_height * self.scale)))
+
+    def update(self, frametime):
+        """Update the scale after a frame which took frametime seconds.
+
+        Returns whether the scale changed."""
+        if self._frametime is None:
+            self._frametime = frametime
+        else:
+            self._frametime = (
+                self._frametime * ResolutionController._SMOOTHING +
+                frametime * (1 - ResolutionController._SMOOTHING))
+
+        if self._settle > 0:
+            self._settle -= 1
+            return False
+
+        scale = self.scale
+        if self._frametime > self.target_frametime:
+            scale = max(scale - ResolutionController.STEP,
+                        ResolutionController.MIN_SCALE)
+        else:
+            raised = min(scale + ResolutionController.STEP,
+                         ResolutionController.MAX_SCALE)
+            if (self._frametime * (raised / scale) ** 2 <
+                    self.target_frametime):
+                scale = raised
+
+        scale = round(scale, 2)
+        if scale == self.scale:
+            return False
+        self.scale = scale
+        self._settle = ResolutionController._SETTLE_FRAMES
+        return True
@@ -4,32 +4,31 @@ import sdl2.ext
 import ctypes
 import collections
 import os
+import numpy
 import OpenGL.GL as GL
 import OpenGL.GL.shaders as shaders
 import typingdefense.util as util
+import typingdefense.glutils as glutils
 from contextlib import contextmanager
 
 
 class Font(object):
     """Class representing texture-mapped fonts."""
 
-    def __init__(self, filename):
-        with open(filename, 'rb') as f:
-            header = f.read(4).decode()
-            if header != "FONT":
-                raise RuntimeError(
-                    "Invalid font file {}, bad header {}".format(filename,
-                                                                 header))
+    # The glyphs of a pre-baked font never move in the texture.
+    generation = 0
 
-            texture_name_length = int.from_bytes(f.read(4), byteorder='little')
-            if texture_name_length < 0:
-                raise RuntimeError(
-                    "Invalid font file {}, bad texture name".format(filename))
+    def __init__(self, filename, load_texture=None):
+        """Load a font.
 
-            texture_name = f.read(texture_name_length).decode()
-            texture_path = "{}/{}".format(os.path.dirname(filename),
-                                          texture_name)
-            self._texture = Texture(texture_path)
+        load_texture is called with the path of the font's image to get its
+        texture, which may be a region of an atlas. By default a texture of
+        its own is loaded."""
+        if load_texture is None:
+            load_texture = Texture
+
+        with open(filename, 'rb') as f:
+            self._texture = load_texture(Font._read_texture_path(f, filename))
 
             # Skip the two bytes of image height and width, which we get from
             # the image itself.
@@ -50,6 +49,51 @@ class Font(object):
                     int.from_bytes(f.read(4), byteorder='little'))
                 c = f.read(1).decode()
 
+        # Lookup tables indexed by character code, holding the advance of each
+        # character (relative to the text height) and its texture
+        # coordinates. Characters which aren't in the font have zero advance.
+        self.advances = numpy.zeros(max(map(ord, self._chars), default=0) + 1,
+                                    numpy.float32)
+        self.uvs = numpy.zeros((len(self.advances), 8), numpy.float32)
+        for c in self._chars:
+            self.advances[ord(c)] = self.char_width(c, 1)
+            self.uvs[ord(c)] = self.texcoords(c)
+
+    @staticmethod
+    def _read_texture_path(f, filename):
+        """Read the header of a font file, up to the name of its image.
+
+        Returns the path of the image."""
+        header = f.read(4).decode()
+        if header != "FONT":
+            raise RuntimeError(
+                "Invalid font file {}, bad header {}".format(filename,
+                                                             header))
+
+        texture_name_length = int.from_bytes(f.read(4), byteorder='little')
+        if texture_name_length < 0:
+            raise RuntimeError(
+                "Invalid font file {}, bad texture name".format(filename))
+
+        texture_name = f.read(texture_name_length).decode()
+        return "{}/{}".format(os.path.dirname(filename), texture_name)
+
+    @staticmethod
+    def texture_path(filename):
+        """Find the path of the image used by a font file."""
+        with open(filename, 'rb') as f:
+            return Font._read_texture_path(f, filename)
+
+    def glyph_indices(self, text):
+        """Return the indices of the characters of text in the tables."""
+        indices = numpy.fromiter(map(ord, text), numpy.int32, len(text))
+        indices[indices >= len(self.advances)] = 0
+        return indices
+
+    @property
+    def texture(self):
+        return self._texture
+
     @contextmanager
     def bind(self):
         """Bind the texture for a font."""
@@ -75,33 +119,259 @@ class Font(object):
             return [0, 0, 0, 0, 0, 0, 0, 0]
 
         charinfo = self._chars[c]
-        x = charinfo.x / self._texture.width
-        y = charinfo.y / self._texture.height
-        w = charinfo.width / self._texture.width
-        h = self._charheight / self._texture.height
+        x, y, w, h = self._texture.texcoords_rect(charinfo.x, charinfo.y,
+                                                  charinfo.width,
+                                                  self._charheight)
         return [x,     y + h,  # Bottom Left
                 x + w, y + h,  # Bottom Right
                 x,     y,      # Top Left
                 x + w, y]      # Top Right
 
 
+class DynamicFont(object):
+    """Class representing fonts rasterised on demand from a TrueType file.
+
+    Glyphs are rendered into square cells of an atlas page the first time
+    they are used, so any character in the font can be drawn without baking
+    a texture for the whole character set. Only the cells of new glyphs are
+    uploaded when the font is next bound.
+
+    When the page is full, the least recently used glyph is evicted, unless
+    it has been used in the current frame, in which case the page grows
+    instead, so a frame's text never evicts glyphs it still needs. Either
+    changes the texture coordinates of glyphs, so the generation counter is
+    incremented, and text laid out with an older generation must be laid
+    out again."""
+    # The width of the page, and the largest height it can grow to.
+    PAGE_WIDTH = 512
+    MAX_PAGE_HEIGHT = 4096
+
+    def __init__(self, filename, size):
+        self._font = None
+
+        # SDL_ttf is only needed for dynamic fonts, so only require it here.
+        import sdl2.sdlttf as sdlttf
+        self._sdlttf = sdlttf
+
+        if not sdlttf.TTF_WasInit() and sdlttf.TTF_Init() != 0:
+            raise RuntimeError(
+                "Could not initialise SDL_ttf: {}".format(
+                    sdlttf.TTF_GetError()))
+
+        self._font = sdlttf.TTF_OpenFont(filename.encode(), size)
+        if not self._font:
+            raise RuntimeError(
+                "Invalid font file {}: {}".format(filename,
+                                                  sdlttf.TTF_GetError()))
+        self._filename = filename
+
+        # Glyphs are stored in square cells, one line high, numbered from 1
+        # along the rows of the page. Glyphs wider than a line are clipped.
+        self._cell = sdlttf.TTF_FontLineSkip(self._font)
+        self._columns = DynamicFont.PAGE_WIDTH // self._cell
+        self._pixels = numpy.zeros((0, DynamicFont.PAGE_WIDTH, 4),
+                                   numpy.uint8)
+        self._texture = None
+        self._free = []
+
+        # The cell and width of each glyph in the page, in least recently
+        # used order, and the frame each was last used in.
+        self._charinfo = collections.namedtuple('CharInfo',
+                                                ['index', 'width'])
+        self._chars = collections.OrderedDict()
+        self._used = {}
+
+        # Lookup tables indexed by cell, as for Font. Index 0 is used for
+        # characters which can't be rendered.
+        self.advances = numpy.zeros(1, numpy.float32)
+        self.uvs = numpy.zeros((1, 8), numpy.float32)
+        self._dirty = []
+        self._upload_all = False
+        self.generation = 0
+        self._grow()
+
+    def __del__(self):
+        if self._font:
+            self._sdlttf.TTF_CloseFont(self._font)
+
+    def _cell_position(self, index):
+        """Find the top left corner of a cell, in pixels."""
+        return ((index - 1) % self._columns * self._cell,
+                (index - 1) // self._columns * self._cell)
+
+    def _cell_texcoords(self, index, width):
+        """Calculate the texture coordinates of the glyph in a cell.
+
+        The coordinates are in the same order as Font.texcoords."""
+        x, y = self._cell_position(index)
+        x, y, w, h = self._texture.texcoords_rect(x, y, width, self._cell)
+        return [x,     y + h,  # Bottom Left
+                x + w, y + h,  # Bottom Right
+                x,     y,      # Top Left
+                x + w, y]      # Top Right
+
+    def _grow(self):
+        """Double the height of the page, adding rows of free cells."""
+        height = max(len(self._pixels) * 2, DynamicFont.PAGE_WIDTH)
+        if height > DynamicFont.MAX_PAGE_HEIGHT:
+            raise RuntimeError(
+                "Too many glyphs in use at once in font {}".format(
+                    self._filename))
+
+        pixels = numpy.zeros((height, DynamicFont.PAGE_WIDTH, 4), numpy.uint8)
+        pixels[:len(self._pixels)] = self._pixels
+        self._pixels = pixels
+
+        first = len(self.advances)
+        count = (height // self._cell) * self._columns + 1
+        self._free.extend(reversed(range(first, count)))
+        self.advances = numpy.resize(self.advances, count)
+        self.advances[first:] = 0
+        self.uvs = numpy.resize(self.uvs, (count, 8))
+        self.uvs[first:] = 0
+
+        # The texture coordinates of the existing glyphs change with the
+        # height of the page.
+        self._texture = Texture(width=DynamicFont.PAGE_WIDTH, height=height)
+        self._upload_all = True
+        for charinfo in self._chars.values():
+            self.uvs[charinfo.index] = self._cell_texcoords(charinfo.index,
+                                                            charinfo.width)
+        self.generation += 1
+
+    def _rasterise(self, c):
+        """Render a glyph to an array of RGBA pixels, clipped to a cell.
+
+        Returns None if the character can't be rendered."""
+        rendered = self._sdlttf.TTF_RenderUTF8_Blended(
+            self._font, c.encode(), sdl2.SDL_Color(255, 255, 255, 255))
+        if not rendered:
+            return None
+        try:
+            surface = sdl2.SDL_ConvertSurfaceFormat(
+                rendered, sdl2.SDL_PIXELFORMAT_RGBA32, 0)
+        finally:
+            sdl2.SDL_FreeSurface(rendered)
+
+        try:
+            contents = surface.contents
+            rows = numpy.ctypeslib.as_array(
+                ctypes.cast(contents.pixels, ctypes.POINTER(ctypes.c_uint8)),
+                shape=(contents.h, contents.pitch))
+            pixels = rows[:, 0:contents.w * 4].reshape(contents.h,
+                                                       contents.w, 4)
+            return pixels[0:self._cell, 0:self._cell].copy()
+        finally:
+            sdl2.SDL_FreeSurface(surface)
+
+    def _glyph(self, c):
+        """Look up the cell of a glyph, rasterising it if it isn't in the
+        page, and mark it as used in the current frame."""
+        frame = glutils.state.frame
+        if c in self._chars:
+            self._chars.move_to_end(c)
+            self._used[c] = frame
+            return self._chars[c].index
+
+        pixels = self._rasterise(c)
+        if pixels is None:
+            return 0
+
+        if not self._free:
+            oldest = next(iter(self._chars))
+            if self._used[oldest] == frame:
+                # Every glyph has been used this frame.
+                self._grow()
+            else:
+                self._free.append(self._chars.pop(oldest).index)
+                del self._used[oldest]
+                self.generation += 1
+        index = self._free.pop()
+
+        x, y = self._cell_position(index)
+        height, width, _ = pixels.shape
+        self._pixels[y:y + self._cell, x:x + self._cell] = 0
+        self._pixels[y:y + height, x:x + width] = pixels
+        self._dirty.append(index)
+
+        self._chars[c] = self._charinfo(index, width)
+        self._used[c] = frame
+        self.advances[index] = width / self._cell
+        self.uvs[index] = self._cell_texcoords(index, width)
+        return index
+
+    def glyph_indices(self, text):
+        """Return the indices of the characters of text in the tables.
+
+        This rasterises any characters which aren't already in the page."""
+        return numpy.fromiter((self._glyph(c) for c in text), numpy.int32,
+                              len(text))
+
+    @property
+    def texture(self):
+        return self._texture
+
+    def _upload(self):
+        """Copy new glyphs to the texture, which must be bound."""
+        if self._upload_all:
+            GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, 0, 0,
+                               DynamicFont.PAGE_WIDTH, len(self._pixels),
+                               GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, self._pixels)
+        else:
+            for index in self._dirty:
+                x, y = self._cell_position(index)
+                cell = numpy.ascontiguousarray(
+                    self._pixels[y:y + self._cell, x:x + self._cell])
+                GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, x, y, self._cell,
+                                   self._cell, GL.GL_RGBA,
+                                   GL.GL_UNSIGNED_BYTE, cell)
+        self._dirty = []
+        self._upload_all = False
+
+    @contextmanager
+    def bind(self):
+        """Bind the texture for a font, uploading any new glyphs."""
+        with self._texture.bind():
+            if self._dirty or self._upload_all:
+                self._upload()
+            yield
+
+
 class Texture(object):
-    def __init__(self, filename):
-        self.filename = filename
-        image = sdl2.ext.load_image(filename)
-        self._width = image.w
-        self._height = image.h
+    def __init__(self, filename=None, width=0, height=0):
+        """Load a texture from an image file.
 
-        if sdl2.SDL_ISPIXELFORMAT_ALPHA(image.format.contents.format):
-            pixel_format = GL.GL_RGBA
+        If no filename is given, an empty RGBA texture of the given width and
+        height is created instead.
+        """
+        self.filename = filename
+        image = None
+        if filename is not None:
+            image = sdl2.ext.load_image(filename)
+            width, height = (image.w, image.h)
+            pixels = ctypes.c_void_p(image.pixels)
+            if sdl2.SDL_ISPIXELFORMAT_ALPHA(image.format.contents.format):
+                pixel_format = GL.GL_RGBA
+            else:
+                pixel_format = GL.GL_RGB
         else:
-            pixel_format = GL.GL_RGB
+            pixels = None
+            pixel_format = GL.GL_RGBA
+
+        self._width = width
+        self._height = height
 
         self._id = GL.glGenTextures(1)
+        glutils.tracker.track(self, 'texture', self._id, width * height * 4)
         with self.bind():
-            GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGBA, image.w, image.h,
-                            0, pixel_format, GL.GL_UNSIGNED_BYTE,
-                            ctypes.c_void_p(image.pixels))
+            try:
+                GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGBA, width,
+                                height, 0, pixel_format, GL.GL_UNSIGNED_BYTE,
+                                pixels)
+            finally:
+                # The pixels have been copied to the texture.
+                if image is not None:
+                    sdl2.SDL_FreeSurface(ctypes.byref(image))
             GL.glTexParameterf(GL.GL_TEXTURE_2D,
                                GL.GL_TEXTURE_MIN_FILTER,
                                GL.GL_LINEAR)
@@ -109,13 +379,14 @@ class Texture(object):
                                GL.GL_TEXTURE_MAG_FILTER,
                                GL.GL_LINEAR)
 
+    @property
+    def id(self):
+        return self._id
+
     @contextmanager
     def bind(self):
-        GL.glBindTexture(GL.GL_TEXTURE_2D, self._id)
-        try:
-            yield
-        finally:
-            GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        glutils.state.bind_texture(self._id)
+        yield
 
     @property
     def width(self):
@@ -125,6 +396,116 @@ class Texture(object):
     def height(self):
         return self._height
 
+    def texcoords_rect(self, x, y, width, height):
+        """Convert a rectangle in pixels to texture coordinates.
+
+        Returns the texture coordinates of the top left of the rectangle, and
+        its width and height."""
+        return (x / self._width, y / self._height,
+                width / self._width, height / self._height)
+
+
+class AtlasRegion(object):
+    """An image packed into a texture atlas.
+
+    A region can be used in place of a Texture, binding the atlas texture and
+    converting coordinates within the image to coordinates in the atlas."""
+    def __init__(self, atlas, x, y, width, height):
+        self._atlas = atlas
+        self._x = x
+        self._y = y
+        self._width = width
+        self._height = height
+
+    @property
+    def id(self):
+        return self._atlas.id
+
+    def bind(self):
+        return self._atlas.bind()
+
+    @property
+    def width(self):
+        return self._width
+
+    @property
+    def height(self):
+        return self._height
+
+    def texcoords_rect(self, x, y, width, height):
+        """Convert a rectangle in pixels to texture coordinates.
+
+        The rectangle is relative to the image, and the coordinates returned
+        are those in the atlas, in the same form as Texture.texcoords_rect.
+        """
+        return self._atlas.texcoords_rect(self._x + x, self._y + y,
+                                          width, height)
+
+
+class Atlas(object):
+    """A texture holding several images, packed into shelves.
+
+    Each image is separated from its neighbours by a gap of PADDING pixels,
+    so that filtering doesn't blend in the edges of other images."""
+    PADDING = 1
+
+    def __init__(self, paths):
+        """Load the images at the given paths and pack them.
+
+        The region holding each image is stored in regions, keyed by path."""
+        images = []
+        for path in paths:
+            image = sdl2.ext.load_image(path)
+            try:
+                surface = sdl2.SDL_ConvertSurfaceFormat(
+                    ctypes.byref(image), sdl2.SDL_PIXELFORMAT_RGBA32, 0)
+            finally:
+                sdl2.SDL_FreeSurface(ctypes.byref(image))
+            if not surface:
+                raise RuntimeError(
+                    "Could not convert image {}: {}".format(
+                        path, sdl2.SDL_GetError().decode()))
+            images.append((path, surface))
+
+        # Place the images in rows, tallest first, so that each row wastes
+        # as little space as possible.
+        images.sort(key=lambda image: image[1].contents.h, reverse=True)
+        pad = Atlas.PADDING
+        area = sum((s.contents.w + pad) * (s.contents.h + pad)
+                   for _, s in images)
+        width = Atlas._power_of_two(max([numpy.sqrt(area)] +
+                                        [s.contents.w + pad
+                                         for _, s in images]))
+        x, y, row_height = (0, 0, 0)
+        placements = []
+        for path, surface in images:
+            w, h = (surface.contents.w, surface.contents.h)
+            if x + w > width:
+                x, y, row_height = (0, y + row_height + pad, 0)
+            placements.append((path, surface, x, y))
+            x += w + pad
+            row_height = max(row_height, h)
+        height = Atlas._power_of_two(y + row_height)
+
+        self.texture = Texture(width=width, height=height)
+        self.regions = {}
+        with self.texture.bind():
+            for path, surface, x, y in placements:
+                w, h = (surface.contents.w, surface.contents.h)
+                GL.glPixelStorei(GL.GL_UNPACK_ROW_LENGTH,
+                                 surface.contents.pitch // 4)
+                GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, x, y, w, h,
+                                   GL.GL_RGBA, GL.GL_UNSIGNED_BYTE,
+                                   ctypes.c_void_p(surface.contents.pixels))
+                sdl2.SDL_FreeSurface(surface)
+                self.regions[path] = AtlasRegion(self.texture, x, y, w, h)
+            GL.glPixelStorei(GL.GL_UNPACK_ROW_LENGTH, 0)
+
+    @staticmethod
+    def _power_of_two(size):
+        """Round a size up to a power of two."""
+        return 1 << max(int(numpy.ceil(size)) - 1, 0).bit_length()
+
 
 class Shader(object):
     def __init__(self, filename, shader_type):
@@ -139,6 +520,13 @@ class ShaderProgram(object):
     def __init__(self, vertex_shader, fragment_shader, uniforms=None):
         self.program = shaders.compileProgram(vertex_shader.shader,
                                               fragment_shader.shader)
+
+        # Connect any shared uniform blocks used by the program to their
+        # binding points.
+        for name, binding in glutils.UNIFORM_BLOCKS.items():
+            block = GL.glGetUniformBlockIndex(self.program, name)
+            if block != GL.GL_INVALID_INDEX:
+                GL.glUniformBlockBinding(self.program, block, binding)
         self._uniforms = {}
         if uniforms is not None:
             for uniform in uniforms:
@@ -150,8 +538,8 @@ class ShaderProgram(object):
                                                               uniform)
 
     def use(self):
-        GL.glUseProgram(self.program)
-        return util.OptionalContextManager(lambda: GL.glUseProgram(0))
+        glutils.state.use_program(self.program)
+        return util.OptionalContextManager(lambda: None)
 
     def uniform(self, name):
         self._lookup_uniform(name)
@@ -169,17 +557,43 @@ class Resources(object):
         self._shaders = {}
         self._shader_programs = {}
         self._fonts = {}
+        self._atlas = None
 
     def _build_path(self, path, filename):
         return "/".join([self.resource_path, path, filename])
 
-    def load_texture(self, filename):
-        path = self._build_path(self.texture_path, filename)
+    def build_atlas(self, textures=(), fonts=()):
+        """Pack images into a single texture atlas.
+
+        textures are the filenames of images, and fonts the filenames of
+        pre-baked fonts whose images should be included. Anything loaded
+        later which uses one of the images gets its region of the atlas
+        instead of a texture of its own, so it can be drawn without changing
+        the bound texture. This should be called before any of the textures
+        or fonts are loaded."""
+        paths = [self._build_path(self.texture_path, f) for f in textures]
+        paths.extend(Font.texture_path(self._build_path(self.font_path, f))
+                     for f in fonts)
+        self._atlas = Atlas(paths)
+
+    @property
+    def atlas(self):
+        """The texture atlas, or None if one hasn't been built."""
+        return self._atlas
+
+    def _load_texture_path(self, path):
+        if self._atlas is not None and path in self._atlas.regions:
+            return self._atlas.regions[path]
         if path not in self._textures:
             self._textures[path] = Texture(path)
 
         return self._textures[path]
 
+    def load_texture(self, filename):
+        """Load a texture, or find its region in the atlas."""
+        return self._load_texture_path(
+            self._build_path(self.texture_path, filename))
+
     def load_shader(self, filename, shader_type):
         path = self._build_path(self.shader_path, filename)
         if path not in self._shaders:
@@ -198,9 +612,17 @@ class Resources(object):
 
         return self._shader_programs[(vs_path, fs_path)]
 
-    def load_font(self, filename):
-        path = self._build_path(self.font_path, filename)
-        if path not in self._fonts:
-            self._fonts[path] = Font(path)
+    def load_font(self, filename, size=None):
+        """Load a font.
 
-        return self._fonts[path]
+        Pre-baked .fnt fonts are loaded as a Font. TrueType fonts are loaded
+        as a DynamicFont, rasterised at the given point size."""
+        path = self._build_path(self.font_path, filename)
+        if (path, size) not in self._fonts:
+            if os.path.splitext(filename)[1] in ('.ttf', '.otf'):
+                self._fonts[(path, size)] = DynamicFont(path, size)
+            else:
+                self._fonts[(path, size)] = Font(path,
+                                                 self._load_texture_path)
+
+        return self._fonts[(path, size)]
@@ -0,0 +1,470 @@
+"""Module for drawing the terrain of a level."""
+import collections
+import ctypes
+import numpy
+from enum import Enum, unique
+from OpenGL import GL
+import typingdefense.glutils as glutils
+import typingdefense.mesh as mesh
+import typingdefense.render as render
+import typingdefense.vector as vector
+
+
+@unique
+class PositionFormat(Enum):
+    """Formats for storing the positions of terrain vertices."""
+    float32 = 1
+    # Half floats, relative to the corner of the chunk.
+    float16 = 2
+    # Integers in fixed steps, relative to the corner of the chunk.
+    int16 = 3
+
+
+@unique
+class ColourFormat(Enum):
+    """Formats for storing the colours of terrain vertices."""
+    float32 = 1
+    # Normalised RGBA bytes.
+    uint8 = 2
+    # An index into the terrain's palette of colours.
+    palette = 3
+
+
+class VertexFormat(object):
+    """The memory layout of the vertices of the terrain mesh.
+
+    Positions are decoded by the shader by multiplying them by
+    position_scale and adding the chunk's position offset. The default format
+    uses int16 positions and a palette index, taking 8 bytes per vertex."""
+    # The number of steps per world unit of int16 positions.
+    QUANTISATION = 128
+
+    _POSITION_TYPES = {PositionFormat.float32: (numpy.float32, GL.GL_FLOAT),
+                       PositionFormat.float16: (numpy.float16,
+                                                GL.GL_HALF_FLOAT),
+                       PositionFormat.int16: (numpy.int16, GL.GL_SHORT)}
+
+    def __init__(self, positions=PositionFormat.int16,
+                 colours=ColourFormat.palette):
+        self.positions = positions
+        self.colours = colours
+
+        position_type, self._position_gl_type = (
+            VertexFormat._POSITION_TYPES[positions])
+        fields = [('position', position_type, 3)]
+        if positions != PositionFormat.float32:
+            # Pad 6-byte positions to 8 bytes, using the padding for the
+            # palette index if there is one.
+            if colours == ColourFormat.palette:
+                fields.append(('index', numpy.uint16))
+            else:
+                fields.append(('pad', numpy.uint16))
+        elif colours == ColourFormat.palette:
+            fields.append(('index', numpy.uint16))
+            fields.append(('pad', numpy.uint16))
+
+        if colours == ColourFormat.float32:
+            fields.append(('colour', numpy.float32, 4))
+        elif colours == ColourFormat.uint8:
+            fields.append(('colour', numpy.uint8, 4))
+        self.dtype = numpy.dtype(fields)
+
+        if positions == PositionFormat.int16:
+            self.position_scale = 1 / VertexFormat.QUANTISATION
+        else:
+            self.position_scale = 1.0
+
+    def setup_attributes(self):
+        """Set up the vertex attributes, with the vertex array bound."""
+        stride = self.dtype.itemsize
+        GL.glEnableVertexAttribArray(0)
+        GL.glVertexAttribPointer(0, 3, self._position_gl_type, GL.GL_FALSE,
+                                 stride, None)
+        if self.colours == ColourFormat.palette:
+            GL.glEnableVertexAttribArray(2)
+            GL.glVertexAttribPointer(
+                2, 1, GL.GL_UNSIGNED_SHORT, GL.GL_FALSE, stride,
+                ctypes.c_void_p(self.dtype.fields['index'][1]))
+        else:
+            gl_type, normalised = (
+                (GL.GL_FLOAT, GL.GL_FALSE)
+                if self.colours == ColourFormat.float32
+                else (GL.GL_UNSIGNED_BYTE, GL.GL_TRUE))
+            GL.glEnableVertexAttribArray(1)
+            GL.glVertexAttribPointer(
+                1, 4, gl_type, normalised, stride,
+                ctypes.c_void_p(self.dtype.fields['colour'][1]))
+
+    def pack(self, positions, colours):
+        """Pack vertex positions and colours into this format.
+
+        colours holds RGBA colours from 0 to 1, or palette indices. Returns
+        the packed vertices and the offset to add to the decoded positions.
+        """
+        verts = numpy.zeros(len(positions), self.dtype)
+        if self.positions == PositionFormat.int16:
+            # Quantise the absolute positions before taking the offset, so
+            # that vertices shared between chunks round the same way.
+            steps = numpy.round(positions * VertexFormat.QUANTISATION)
+            origin = steps.min(axis=0)
+            steps -= origin
+            if steps.max(initial=0) > numpy.iinfo(numpy.int16).max:
+                raise RuntimeError('Terrain chunk is too large for int16 '
+                                   'positions')
+            verts['position'] = steps
+            offset = origin / VertexFormat.QUANTISATION
+        elif self.positions == PositionFormat.float16:
+            offset = positions.min(axis=0)
+            verts['position'] = positions - offset
+        else:
+            offset = numpy.zeros(3)
+            verts['position'] = positions
+
+        if self.colours == ColourFormat.palette:
+            verts['index'] = colours[:, 0]
+        elif self.colours == ColourFormat.uint8:
+            verts['colour'] = numpy.round(colours * 255)
+        else:
+            verts['colour'] = colours
+        return verts, offset.astype(numpy.float32)
+
+
+class _Palette(object):
+    """The colours of the terrain, in a uniform buffer.
+
+    Vertices using the palette colour format refer to colours by their index
+    in the palette. Each colour is counted against the owners, such as
+    chunks, which use it, and its slot is freed for reuse once no owner
+    does."""
+    SIZE = 256
+
+    def __init__(self):
+        self._indices = {}
+        self._free = list(reversed(range(_Palette.SIZE)))
+        self._counts = collections.Counter()
+        self._owners = {}
+        self._colours = numpy.zeros((_Palette.SIZE, 4), numpy.float32)
+        self._dirty = False
+
+        self._id = GL.glGenBuffers(1)
+        glutils.tracker.track(self, 'buffer', self._id)
+        glutils.state.bind_buffer(GL.GL_UNIFORM_BUFFER, self._id)
+        glutils.buffer_data(GL.GL_UNIFORM_BUFFER, self._colours.nbytes,
+                            self._colours, GL.GL_DYNAMIC_DRAW)
+        GL.glBindBufferBase(GL.GL_UNIFORM_BUFFER,
+                            glutils.UNIFORM_BLOCKS['Palette'], self._id)
+
+    def assign(self, owner, colours):
+        """Find the indices of the colours used by an owner.
+
+        Colours the owner didn't use before are added to the palette if
+        needed, and those it no longer uses are released. Returns an array
+        of indices, or None if there isn't room for the new colours, in
+        which case the palette is left unchanged."""
+        keys = [(c.r, c.g, c.b, c.a) for c in colours]
+        used = set(keys)
+        old = self._owners.get(owner, set())
+        added = [k for k in used if k not in self._indices]
+        freed = [k for k in old - used if self._counts[k] == 1]
+        if len(added) > len(self._free) + len(freed):
+            return None
+
+        for key in old - used:
+            self._release_colour(key)
+        for key in used - old:
+            if key not in self._indices:
+                index = self._free.pop()
+                self._indices[key] = index
+                self._colours[index] = key
+                self._dirty = True
+            self._counts[key] += 1
+        self._owners[owner] = used
+        return numpy.array([self._indices[k] for k in keys], numpy.int64)
+
+    def release(self, owner):
+        """Release all the colours used by an owner."""
+        for key in self._owners.pop(owner, ()):
+            self._release_colour(key)
+
+    def _release_colour(self, key):
+        self._counts[key] -= 1
+        if self._counts[key] == 0:
+            del self._counts[key]
+            self._free.append(self._indices.pop(key))
+
+    def colours(self, indices):
+        """Look up the RGBA colours of an array of palette indices."""
+        return self._colours[numpy.asarray(indices, numpy.int64)]
+
+    def update(self):
+        """Upload any new colours."""
+        if self._dirty:
+            glutils.state.bind_buffer(GL.GL_UNIFORM_BUFFER, self._id)
+            GL.glBufferSubData(GL.GL_UNIFORM_BUFFER, 0, self._colours.nbytes,
+                               self._colours)
+            self._dirty = False
+
+
+class _Chunk(object):
+    """The mesh for a block of tiles.
+
+    Only the faces are drawn by the chunk. Its outline segments are drawn
+    by the terrain's thick lines, as a group keyed by the chunk's key."""
+    def __init__(self, vertex_format):
+        self.face_index_count = 0
+        self.bounds = None
+        self.position_offset = None
+        self._index_type = GL.GL_UNSIGNED_INT
+
+        self._vao = glutils.VertexArray()
+        self._vbo = glutils.VertexBuffer()
+        self._ibo = glutils.IndexBuffer()
+        with self._vao.bind():
+            self._vbo.bind()
+            self._ibo.bind()
+            vertex_format.setup_attributes()
+
+    def build(self, verts, position_offset, bounds, face_indices):
+        """Upload a new mesh for the chunk.
+
+        16-bit indices are used if there are few enough vertices."""
+        indices = numpy.asarray(face_indices)
+        if len(verts) <= numpy.iinfo(numpy.uint16).max + 1:
+            indices = indices.astype(numpy.uint16)
+            self._index_type = GL.GL_UNSIGNED_SHORT
+        else:
+            self._index_type = GL.GL_UNSIGNED_INT
+        self.face_index_count = len(face_indices)
+        self.bounds = bounds
+        self.position_offset = position_offset
+
+        with self._vao.bind():
+            self._vbo.bind()
+            glutils.buffer_data(GL.GL_ARRAY_BUFFER, verts.nbytes, verts,
+                                GL.GL_STATIC_DRAW)
+            glutils.buffer_data(GL.GL_ELEMENT_ARRAY_BUFFER, indices.nbytes,
+                                indices, GL.GL_STATIC_DRAW)
+
+    @property
+    def vertex_array(self):
+        return self._vao
+
+    def draw(self):
+        """Draw the faces of the chunk.
+
+        The terrain shader must be in use."""
+        with self._vao.bind():
+            GL.glDrawElements(GL.GL_TRIANGLES, self.face_index_count,
+                              self._index_type, None)
+
+
+class Terrain(object):
+    """The terrain of a level.
+
+    The tiles are split into chunks, covering square blocks of axial
+    coordinates, each of which has its own mesh. When tiles are edited only
+    the affected chunks are marked dirty, and these are rebuilt before the
+    next draw. Chunks whose bounding boxes are outside the camera's view are
+    not drawn.
+
+    The outlines are drawn as thick lines. Each chunk's outline segments
+    have their own range of a shared buffer, so only the ranges of rebuilt
+    chunks are uploaded, and only those of visible chunks are drawn.
+
+    The layout of the vertices is given by vertex_format, a VertexFormat. If
+    it uses the palette, and the terrain has more colours than the palette
+    holds, the terrain switches to uint8 colours in the vertices."""
+    CHUNK_SIZE = 16
+
+    # The width of the outlines, in pixels.
+    OUTLINE_WIDTH = 2
+
+    def __init__(self, app, level, tile_size, tile_depth,
+                 vertex_format=None):
+        self._level = level
+        self._tile_size = tile_size
+        self._tile_depth = tile_depth
+        if vertex_format is None:
+            vertex_format = VertexFormat()
+        self._format = vertex_format
+        self._palette = _Palette()
+        self._shader = glutils.ShaderInstance(
+            app, 'level2.vs', 'level2.fs',
+            [('positionScale', GL.GL_FLOAT, vertex_format.position_scale),
+             ('positionOffset', GL.GL_FLOAT_VEC3, [0, 0, 0]),
+             ('usePalette', GL.GL_INT,
+              int(vertex_format.colours == ColourFormat.palette))])
+        self._lines = glutils.ThickLines(app, Terrain.OUTLINE_WIDTH)
+        self._chunks = {}
+        self._dirty = set()
+
+        # The keys and bounding boxes of the chunks, for culling.
+        self._chunk_keys = []
+        self._chunk_list = []
+        self._mins = numpy.empty((0, 3), numpy.float32)
+        self._maxs = numpy.empty((0, 3), numpy.float32)
+        for tile in level.iter_tiles():
+            self._dirty.add(Terrain._chunk_key(tile.q, tile.r))
+
+    @staticmethod
+    def _chunk_key(q, r):
+        """Find the chunk containing the tile with the given coordinates."""
+        return (int(q) // Terrain.CHUNK_SIZE, int(r) // Terrain.CHUNK_SIZE)
+
+    def mark_dirty(self, coords):
+        """Mark the tile at the given coordinates as changed.
+
+        The chunks containing the tile and its neighbours are rebuilt, since
+        changing the height of a tile can expose the sides of its
+        neighbours."""
+        self._dirty.add(Terrain._chunk_key(coords.q, coords.r))
+        for dq, dr in mesh.SIDE_DIRECTIONS:
+            self._dirty.add(Terrain._chunk_key(coords.q + dq, coords.r + dr))
+
+    def _tile_block(self, q, r, size):
+        """Get a block of tiles from the level.
+
+        Returns an object array indexed by [q, r], relative to the given
+        coordinates, containing None for coordinates without a tile."""
+        tiles = self._level.tiles
+        block = numpy.full((size, size), None, dtype=object)
+        start = self._level.tile_coords_to_array_index(vector.Vector(q, r))
+        q0, r0 = (max(int(start.x), 0), max(int(start.y), 0))
+        q1 = min(int(start.x) + size, tiles.shape[1])
+        r1 = min(int(start.y) + size, tiles.shape[0])
+        if q1 > q0 and r1 > r0:
+            block[q0 - int(start.x):q1 - int(start.x),
+                  r0 - int(start.y):r1 - int(start.y)] = tiles[r0:r1,
+                                                               q0:q1].T
+        return block
+
+    def _rebuild(self, key):
+        """Rebuild the mesh of a chunk.
+
+        Returns False if the chunk's colours don't fit in the palette."""
+        q = key[0] * Terrain.CHUNK_SIZE
+        r = key[1] * Terrain.CHUNK_SIZE
+
+        # Include a border of neighbouring tiles, for hidden face removal.
+        block = self._tile_block(q - 1, r - 1, Terrain.CHUNK_SIZE + 2)
+        heights = numpy.zeros(block.shape, numpy.int64)
+        offsets = []
+        tiles = []
+        for (i, j), tile in numpy.ndenumerate(block):
+            if tile:
+                heights[i, j] = tile.height
+                if (0 < i <= Terrain.CHUNK_SIZE and
+                        0 < j <= Terrain.CHUNK_SIZE):
+                    offsets.append((i, j))
+                    tiles.append(tile)
+
+        if not tiles:
+            self._chunks.pop(key, None)
+            self._lines.remove(key)
+            self._palette.release(key)
+            return True
+
+        offsets = numpy.array(offsets, numpy.int64)
+        if self._format.colours == ColourFormat.palette:
+            indices = self._palette.assign(
+                key, [c for t in tiles
+                      for c in (t.face_colour, t.outline_colour)])
+            if indices is None:
+                return False
+            info = indices.reshape(-1, 2).astype(numpy.float32)
+        else:
+            info = numpy.array([list(t.face_colour) + list(t.outline_colour)
+                                for t in tiles], numpy.float32)
+        face_colours, outline_colours = numpy.split(info, 2, axis=1)
+        verts, face_indices, outline_indices = mesh.terrain(
+            offsets + (q - 1, r - 1), heights[offsets[:, 0], offsets[:, 1]],
+            face_colours, outline_colours, self._tile_size, self._tile_depth,
+            neighbours=mesh.grid_neighbour_heights(heights, offsets))
+
+        positions = verts[:, 0:3]
+        packed, position_offset = self._format.pack(positions, verts[:, 3:])
+
+        # Each outline segment takes the colour of its first vertex.
+        starts = outline_indices[0::2]
+        if self._format.colours == ColourFormat.palette:
+            colours = self._palette.colours(verts[starts, 3])
+        else:
+            colours = verts[starts, 3:]
+        self._lines.upload(key, positions[starts],
+                           positions[outline_indices[1::2]], colours)
+
+        if key not in self._chunks:
+            self._chunks[key] = _Chunk(self._format)
+        self._chunks[key].build(
+            packed, position_offset,
+            (positions.min(axis=0), positions.max(axis=0)),
+            face_indices)
+        return True
+
+    def update(self):
+        """Rebuild any chunks which have changed."""
+        if not self._dirty:
+            return
+
+        while self._dirty:
+            if not self._rebuild(self._dirty.pop()):
+                self._use_vertex_colours()
+
+        self._chunk_keys = list(self._chunks.keys())
+        self._chunk_list = list(self._chunks.values())
+        self._mins = numpy.array([c.bounds[0] for c in self._chunk_list],
+                                 numpy.float32).reshape(-1, 3)
+        self._maxs = numpy.array([c.bounds[1] for c in self._chunk_list],
+                                 numpy.float32).reshape(-1, 3)
+
+    def _use_vertex_colours(self):
+        """Switch to storing colours in the vertices, when there are too many
+        colours for the palette, and rebuild all the chunks."""
+        self._format = VertexFormat(self._format.positions,
+                                    ColourFormat.uint8)
+        self._shader.set_uniform('usePalette', 0, download=False)
+        self._chunks = {}
+        for tile in self._level.iter_tiles():
+            self._dirty.add(Terrain._chunk_key(tile.q, tile.r))
+
+    @property
+    def top(self):
+        """The height of the top of the highest tile."""
+        self.update()
+        return float(self._maxs[:, 2].max(initial=0))
+
+    def draw(self, queue, faces=True, outline=True):
+        """Submit the visible terrain to a render queue.
+
+        Any changed chunks are rebuilt first. The faces of each visible chunk
+        are drawn in the opaque pass, and its outlines in the outline
+        pass."""
+        self.update()
+        cam = self._level.cam
+        visible = cam.boxes_visible(self._mins, self._maxs)
+        depths = numpy.linalg.norm((self._mins + self._maxs) / 2 - cam.origin,
+                                   axis=1)
+        if faces:
+            for chunk, show, depth in zip(self._chunk_list, visible, depths):
+                if show:
+                    queue.submit(render.RenderQueue.OPAQUE,
+                                 self._shader.program, chunk.vertex_array.id,
+                                 self._draw_faces, chunk, depth=depth)
+        if outline:
+            for key, show in zip(self._chunk_keys, visible):
+                if show:
+                    queue.submit(render.RenderQueue.OUTLINE,
+                                 self._lines.program,
+                                 self._lines.vertex_array.id,
+                                 self._draw_outlines, key)
+
+    def _draw_faces(self, chunks):
+        self._palette.update()
+        with self._shader.use():
+            for chunk in chunks:
+                self._shader.set_uniform('positionOffset',
+                                         chunk.position_offset)
+                chunk.draw()
+
+    def _draw_outlines(self, keys):
+        self._lines.draw(keys)
@@ -1,105 +1,153 @@
 """Text using texture-map fonts."""
+import collections
 import ctypes
+import functools
 import numpy
 import typingdefense.glutils as glutils
 import OpenGL.GL as GL
 from enum import Enum, unique
 
 
-class Text(object):
-    """Class for drawing texture-mapped text."""
-
-    @unique
-    class Align(Enum):
-        """Enumeration of text alignments."""
-        left = 1
-        center = 2
-        right = 3
-
-    def __init__(self, font, text, x, y, height, align=Align.left):
-        self._font = font
-        self._vao = glutils.VertexArray()
-        self._vbo = glutils.VertexBuffer()
-        self.height = height
-        self.width = 0
-        self._align = align
-        self._x = x
-        self._y = y
-        self._text = None
-        self.text = text
-
-    @property
-    def text(self):
-        """Get the text associated with the instance."""
-        return self._text
-
-    @text.setter
-    def text(self, text):
-        """Update the text associated with the instance.
-
-        This updates the vertex buffers etc.
-        """
-        if text != self._text:
-            self._text = text
-
-            x, y = (self._x, self._y)
-
-            # If the text isn't left-aligned, calculate how much we need to
-            # adjust the x coordinate by
-            self.width = 0
-            for c in self._text:
-                self.width += self._font.char_width(c, self.height)
-
-            if self._align == Text.Align.center:
-                x -= self.width / 2
-            elif self._align == Text.Align.right:
-                x -= self.width
-
-            data = []
-            for c in self._text:
-                width = self._font.char_width(c, self.height)
-                tc = self._font.texcoords(c)
-
-                data += [x, y, tc[0], tc[1],                        # Bot Left
-                         x + width, y, tc[2], tc[3],                # Bot Right
-                         x, y + self.height, tc[4], tc[5],          # Top Left
-                         x + width, y + self.height, tc[6], tc[7]]  # Top Right
-                x += width
-
-            with self._vao.bind():
-                self._vbo.bind()
-                data_array = numpy.array(data, numpy.float32)
-                GL.glBufferData(GL.GL_ARRAY_BUFFER,
-                                data_array.nbytes, data_array,
-                                GL.GL_STATIC_DRAW)
-                GL.glEnableVertexAttribArray(0)
-                GL.glVertexAttribPointer(0, 2, GL.GL_FLOAT, GL.GL_FALSE, 16,
-                                         None)
-                GL.glEnableVertexAttribArray(1)
-                GL.glVertexAttribPointer(1, 2, GL.GL_FLOAT, GL.GL_FALSE, 16,
-                                         ctypes.c_void_p(8))
-
-    def draw(self, text=None):
-        """Draw the text."""
-        if text is not None and text != self._text:
-            self.text = text
-
-        with self._vao.bind(), self._font.bind():
-            for i in range(len(self._text)):
-                GL.glDrawArrays(GL.GL_TRIANGLE_STRIP, i * 4, 4)
-
-
-class Text2D(Text):
-    """2D Text, used for HUD drawing."""
-    def __init__(self, app, font, text, x, y, height, align=Text.Align.left):
-        super().__init__(font, text, x, y, height, align)
+@unique
+class Align(Enum):
+    """Enumeration of text alignments."""
+    left = 1
+    center = 2
+    right = 3
+
+
+def layout(font, text, height, align):
+    """Lay out a string of text.
+
+    Returns an array of vertices, four per character, each holding an x and y
+    position relative to the text origin and a pair of texture coordinates,
+    along with the width of the text.
+
+    Layouts are cached along with the font's generation, so that they are
+    discarded when glyphs move in the font's texture. Laying out text can
+    move glyphs, so text laid out earlier must be laid out again if the
+    generation changes.
+    """
+    return _layout(font, font.generation, text, height, align)
+
+
+@functools.lru_cache(maxsize=1024)
+def _layout(font, generation, text, height, align):
+    indices = font.glyph_indices(text)
+    widths = font.advances[indices] * height
+    uvs = font.uvs[indices]
+    right = numpy.cumsum(widths)
+    left = right - widths
+    width = float(right[-1]) if len(text) else 0
+
+    # If the text isn't left-aligned, calculate how much we need to adjust
+    # the x coordinate by
+    if align == Align.center:
+        left -= width / 2
+        right -= width / 2
+    elif align == Align.right:
+        left -= width
+        right -= width
+
+    # The vertices of each character are in the order: bottom left, bottom
+    # right, top left, top right.
+    quads = numpy.empty((len(text), 4, 4), numpy.float32)
+    quads[:, 0::2, 0] = left[:, numpy.newaxis]
+    quads[:, 1::2, 0] = right[:, numpy.newaxis]
+    quads[:, 0:2, 1] = 0
+    quads[:, 2:4, 1] = height
+    quads[:, :, 2:4] = uvs.reshape(-1, 4, 2)
+
+    quads = quads.reshape(-1, 4)
+    quads.flags.writeable = False
+    return quads, width
+
+
+class TextBatch(object):
+    """Batches 2D text, such as the HUD, to be drawn together.
+
+    Text is added during the frame and drawn by flush, with one draw call for
+    each texture used, so fonts packed into the same atlas are drawn
+    together. Vertices are written to a stream buffer, so the buffer is not
+    reallocated every time a string changes."""
+    # The initial capacity of the buffer, in characters.
+    CAPACITY = 4096
+
+    # Vertices hold a position in whole pixels and normalised texture
+    # coordinates, taking 8 bytes.
+    _VERTEX = numpy.dtype([('position', numpy.int16, 2),
+                           ('texcoord', numpy.uint16, 2)])
+
+    # Order of the vertices of a character's quad making up its two
+    # triangles.
+    _QUAD_TRIANGLES = [0, 1, 2, 2, 1, 3]
+
+    def __init__(self, app):
         self._shader = glutils.ShaderInstance(
             app, 'ortho.vs', 'texture.fs',
             [('screenDimensions', GL.GL_FLOAT_VEC2,
               [app.window_width, app.window_height]),
+             ('translate', GL.GL_FLOAT_VEC2, [0, 0]),
              ('texUnit', GL.GL_INT, 0)])
+        self._pending = []
 
-    def draw(self, text=None):
-        """Draw the text."""
-        with self._shader.use():
-            super().draw(text)
+        self._vao = glutils.VertexArray()
+        self._vbo = glutils.StreamBuffer(
+            GL.GL_ARRAY_BUFFER,
+            TextBatch.CAPACITY * 6 * TextBatch._VERTEX.itemsize)
+        with self._vao.bind():
+            self._vbo.bind()
+            GL.glEnableVertexAttribArray(0)
+            GL.glVertexAttribPointer(0, 2, GL.GL_SHORT, GL.GL_FALSE, 8, None)
+            GL.glEnableVertexAttribArray(1)
+            GL.glVertexAttribPointer(1, 2, GL.GL_UNSIGNED_SHORT, GL.GL_TRUE,
+                                     8, ctypes.c_void_p(4))
+
+    def add(self, font, text, x, y, height, align=Align.left):
+        """Add a string to be drawn at the given screen position."""
+        if text:
+            self._pending.append((font, text, x, y, height, align))
+
+    def _build(self, font, entries):
+        """Build the triangles for all the strings using a font."""
+        parts = []
+        for _, text, x, y, height, align in entries:
+            quads, _ = layout(font, text, height, align)
+            quads = quads.reshape(-1, 4, 4)[:, TextBatch._QUAD_TRIANGLES]
+            parts.append(quads.reshape(-1, 4) +
+                         numpy.array([x, y, 0, 0], numpy.float32))
+        data = numpy.concatenate(parts)
+
+        verts = numpy.empty(len(data), TextBatch._VERTEX)
+        verts['position'] = numpy.round(data[:, 0:2])
+        verts['texcoord'] = numpy.round(data[:, 2:4] * 65535)
+        return verts
+
+    def flush(self):
+        """Draw all the text added since the last flush."""
+        if not self._pending:
+            return
+
+        # Group the fonts by texture, keeping the order they were added in.
+        textures = collections.OrderedDict()
+        for entry in self._pending:
+            fonts = textures.setdefault(entry[0].texture.id, [])
+            if entry[0] not in fonts:
+                fonts.append(entry[0])
+
+        with self._shader.use(), self._vao.bind():
+            for fonts in textures.values():
+                parts = []
+                for font in fonts:
+                    entries = [e for e in self._pending if e[0] is font]
+                    generation = None
+                    while generation != font.generation:
+                        generation = font.generation
+                        verts = self._build(font, entries)
+                    parts.append(verts)
+                verts = numpy.concatenate(parts)
+
+                first = self._vbo.write(verts) // TextBatch._VERTEX.itemsize
+                with fonts[0].bind():
+                    GL.glDrawArrays(GL.GL_TRIANGLES, first, len(verts))
+        self._pending = []
@@ -1,27 +1,22 @@
 """Module containing the different towers that can be placed by the player."""
-import OpenGL.GL as GL
-import typingdefense.glutils as glutils
 import typingdefense.vector as vector
 import typingdefense.util as util
 
 
 class _BaseTower(object):
+    SIZE = 0.5
+    DEPTH = 2
+    STACKS = 4
+
     def __init__(self, app, level, tile, colour):
-        self._shader = glutils.ShaderInstance(
-            app, 'level.vs', 'level.fs',
-            [('transMatrix', GL.GL_FLOAT_MAT4,
-              level.cam.trans_matrix_as_array()),
-             ('colourIn', GL.GL_FLOAT_VEC4, colour)])
-        self._hex = glutils.Hex(vector.Vector(tile.x, tile.y, tile.top), 0.5, 2,
-                                stacks=4)
+        # The hexes of all towers are drawn together by the level, using this
+        # offset and colour.
+        self.instance = (tile.x, tile.y, tile.top,
+                         colour.r, colour.g, colour.b, colour.a)
 
     def update(self):
         pass
 
-    def draw(self):
-        with self._shader.use():
-            self._hex.draw()
-
 
 class SlowTower(_BaseTower):
     COST = 50
@@ -24,10 +24,13 @@ class Transform(object):
                                                 [0, 0, 0, 1]],
                                                numpy.float32)
         else:
-            self._translate_mat = numpy.identity(4)
+            self._translate_mat = numpy.matrix(numpy.identity(4, numpy.float32))
 
         self.matrix = self._translate_mat
 
+    def as_array(self):
+        return numpy.asarray(self.matrix).reshape(-1)
+
 
 class Timer(object):
     def __init__(self):